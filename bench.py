@@ -0,0 +1,236 @@
+"""
+Benchmarks for the model's hot paths.
+
+Each benchmark runs for several player counts (the board side grows with 
+them) and reports microseconds and allocations per operation:
+
+    board_init      Board.__init__ dealing a new board
+    start           the last set_ready(), which deals the board and starts
+                    the game, also for hundreds of players
+    pick, cap, drop, split, mine
+                    one accepted Player move, validation included
+    board_map       Game.build_board_map(), a get_board_map() cache miss
+    piece_map       Game.build_piece_map(), a get_piece_map() cache miss
+    send_all        Game.send_all() to every player through stub remotes
+    moved           Game.moved() fan-out of one changed stack to every player
+
+Allocations are bytes from tracemalloc where there is one, otherwise the
+net count of new gc tracked objects.
+
+    python bench.py --save baseline.json
+    python bench.py --baseline baseline.json    # flags regressions
+"""
+import sys, time, gc, json, random
+from optparse import OptionParser
+import model
+import snapshot
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+    
+PLAYER_COUNTS = (2, 4, 8, 16, 24)
+LARGE_PLAYER_COUNTS = PLAYER_COUNTS + (100, 200, 400)
+REGRESSION = 1.2
+
+def timed(func, number, repeat=3):
+    """ best seconds per call of func over repeat runs """
+    best = None
+    for i in range(repeat):
+        started = time.time()
+        for j in xrange(number):
+            func()
+        took = (time.time() - started) / number
+        if best is None or took < best:
+            best = took
+    return best
+    
+def allocated(func, number):
+    """ allocations per call of func, results are kept until the end """
+    kept = []
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for j in xrange(number):
+            kept.append(func())
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return float(after - before) / number
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        for j in xrange(number):
+            kept.append(func())
+        return float(len(gc.get_objects()) - before) / number
+    finally:
+        gc.enable()
+        
+def played(num_players):
+    game = model.game_for(num_players)
+    return model.play_randomly(game, 10*num_players, random.Random(num_players))
+    
+def with_remotes(game):
+    for p in game.players:
+        p.remote_board = model.StubRemote()
+    return game
+    
+### BENCHMARKS ###
+
+def bench_board_init(num_players, number):
+    game = model.game_for(num_players)
+    make = lambda: model.Board(game.players)
+    return timed(make, number), allocated(make, number)
+    
+def bench_start(num_players, number):
+    def waiting(count):
+        last = []
+        for i in range(count):
+            game = model.Server().create_game("start")
+            players = [ game.join("player %i"%j) for j in range(num_players) ]
+            for p in players[:-1]:
+                p.set_ready()
+            last.append(players[-1])
+        return iter(last)
+    
+    pending = waiting(number)
+    took = timed(lambda: pending.next().set_ready(), number, repeat=1)
+    pending = waiting(number)
+    return took, allocated(lambda: pending.next().set_ready(), number)
+    
+def find_move(game, kind, rounds=50):
+    """ a player and a move of that kind, playing on until there is one """
+    for i in range(rounds):
+        for p in game.players:
+            if kind in ("cap", "drop") and p.on_hand is None:
+                continue
+            moves = [ m for m in game.board.legal_moves(p) if m[0] == kind ]
+            if moves:
+                return p, moves[0]
+        model.play_randomly(game, 10)
+    return None
+    
+def bench_move(kind):
+    def bench(num_players, number):
+        game = played(num_players)
+        found = find_move(game, kind)
+        if found is None:
+            return None
+        player, move = found
+        
+        data = snapshot.encode(game)
+        def copies(count):
+            made = []
+            for i in range(count):
+                copied = snapshot.decode(data)
+                mover = [ c for c in copied.players if c.code == player.code ][0]
+                args = [ copied.board.piece_map[a.id] 
+                            if isinstance(a, model.Piece) else a 
+                            for a in move[1:] ]
+                made.append( (getattr(mover, kind), args) )
+            return iter(made)
+        
+        best = None
+        for i in range(3):
+            pending = copies(number)
+            call = lambda: apply(*pending.next())
+            took = timed(call, number, repeat=1)
+            if best is None or took < best:
+                best = took
+        pending = copies(number)
+        return best, allocated(lambda: apply(*pending.next()), number)
+    return bench
+    
+def bench_board_map(num_players, number):
+    game = played(num_players)
+    return timed(game.build_board_map, number), allocated(game.build_board_map, number)
+    
+def bench_piece_map(num_players, number):
+    game = played(num_players)
+    return timed(game.build_piece_map, number), allocated(game.build_piece_map, number)
+    
+def bench_send_all(num_players, number):
+    game = with_remotes(played(num_players))
+    return timed(game.send_all, number), allocated(game.send_all, number)
+    
+def bench_moved(num_players, number):
+    game = with_remotes(played(num_players))
+    where = iter(game.board.tops).next()
+    def moved():
+        game.board.touched(where)
+        game.moved()
+    return timed(moved, number), allocated(moved, number)
+    
+BENCHMARKS = [
+    ("board_init", bench_board_init, 50, LARGE_PLAYER_COUNTS),
+    ("start", bench_start, 10, LARGE_PLAYER_COUNTS),
+    ("pick", bench_move("pick"), 200),
+    ("cap", bench_move("cap"), 200),
+    ("drop", bench_move("drop"), 200),
+    ("split", bench_move("split"), 200),
+    ("mine", bench_move("mine"), 200),
+    ("board_map", bench_board_map, 1000),
+    ("piece_map", bench_piece_map, 1000),
+    ("send_all", bench_send_all, 200),
+    ("moved", bench_moved, 1000),
+]
+
+def run(player_counts=PLAYER_COUNTS, only=None):
+    model.VERBOSE = False
+    results = {}
+    unit = tracemalloc and "bytes" or "objects"
+    print "%-12s %8s %6s %12s %12s"%("benchmark", "players", "side", "us/op", 
+                                      unit + "/op")
+    for benchmark in BENCHMARKS:
+        name, bench, number = benchmark[:3]
+        if only and not name in only:
+            continue
+        counts = player_counts
+        if len(benchmark) > 3 and player_counts == PLAYER_COUNTS:
+            counts = benchmark[3]
+        for num_players in counts:
+            result = bench(num_players, number)
+            if result is None:
+                continue
+            took, allocs = result
+            side = model.game_for(num_players).board.side
+            print "%-12s %8i %6i %12.2f %12.1f"%(name, num_players, side, 
+                                                 took*1e6, allocs)
+            results["%s/%i"%(name, num_players)] = {
+                "seconds": took, "allocations": allocs, "unit": unit }
+    return results
+    
+def compare(results, baseline):
+    """ prints the benchmarks that got slower than the baseline """
+    slower = []
+    for key in sorted(results):
+        if key in baseline:
+            ratio = results[key]["seconds"] / baseline[key]["seconds"]
+            if ratio > REGRESSION:
+                slower.append(key)
+                print "REGRESSION %-20s %.2fx slower"%(key, ratio)
+    if not slower:
+        print "no regressions against the baseline"
+    return slower
+    
+    
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("--players", action="append", type="int")
+    parser.add_option("--only", action="append")
+    parser.add_option("--save", help="write the results as a baseline")
+    parser.add_option("--baseline", help="compare against a saved baseline")
+    options, args = parser.parse_args()
+    
+    results = run(options.players or PLAYER_COUNTS, options.only)
+    if options.save:
+        f = open(options.save, "w")
+        json.dump(results, f, indent=1, sort_keys=True)
+        f.close()
+    if options.baseline:
+        f = open(options.baseline)
+        baseline = json.load(f)
+        f.close()
+        if compare(results, baseline):
+            sys.exit(1)
@@ -12,7 +12,7 @@ from twisted.internet import reactor
 from twisted.spread import pb
 from twisted.internet import task
 
-from client import RemoteBoard
+from client import RemoteBoard, GameListener
 import math
 from euclid import *
 import selection
@@ -127,9 +127,29 @@ TOWER_COLOURS = [
 ]
 TOWER_SCALES = [ 0.4, 0.7, 1 ]
 FPS=15
+# how far a rolled back piece goes towards its place every frame
+ROLLBACK_STEP=0.3
+MENU_GAMES=8
 WINDOW_SIZE=(800,600)
 
 
+class GameEvents(GameListener):
+    def __init__(self, game):
+        self.game = game
+
+    def remote_player_joined(self, name):
+        print name, "joined"
+
+    def remote_player_ready(self, name):
+        print name, "is ready"
+
+    def remote_game_started(self, side):
+        self.game.gameStarted(side)
+
+    def remote_game_finished(self, standings, winner):
+        print "game over, winner:", winner
+
+
 class Game:
     server = None
     players = None
@@ -224,6 +244,7 @@ class Game:
         self.root_node.accept(self.compiler)
         self.pieces = {}
         self.onHand = None
+        self.rollingBack = set()
 
     def createBoardGroup(self):
         self.boardGroup = qgl.scene.Group()
@@ -269,7 +290,7 @@ class Game:
 
         playerColours = {}
         for n, playerName in enumerate(self.players):
-            playerColours[playerName] = TOWER_COLOURS[n]
+            playerColours[playerName] = TOWER_COLOURS[n % len(TOWER_COLOURS)]
 
         pyramidTriangles = [
             [(0,2,0), (-1,-1,-1), (1,-1,-1)],
@@ -324,24 +345,23 @@ class Game:
     def gotServer(self, server):
         self.server = server
         print "getting games..."
-        server.callRemote("games").addCallback(self.gotGames)
+        server.callRemote("list_games", 0, MENU_GAMES, "STATUS_WAITING").addCallback(self.gotGames)
 
     def showFailure(self, *f):
         print f
 
-    def gameJoiner(self, game):
+    def gameJoiner(self, gameId):
         def f():
             self.menuDisable()
-            self.server.game = game
-            print "joining game..." + repr(game)
-            game.callRemote("join", self.getPlayerName()).addCallbacks(self.gotPlayer, self.showFailure)
+            print "joining game...", gameId
+            self.server.callRemote("get_game", gameId).addCallbacks(self.gotGame, self.showFailure)
         return f
 
-    def gotGames(self, games):
-        self.server.game = games
+    def gotGames(self, result):
+        total, games = result
         menuOptions = []
-        for game, gamename in games:
-            menuOptions.append( ("Join " + gamename, self.gameJoiner(game) ) )
+        for gameId, gamename, status, numPlayers in games:
+            menuOptions.append( ("Join %s (%i)"%(gamename, numPlayers), self.gameJoiner(gameId) ) )
         menuOptions.append( ("Create new game", self.createGame) )
         self.menuGroup.setOptions(menuOptions)
         self.recompile(self.menuGroup)
@@ -369,6 +389,10 @@ class Game:
         self.server.player.callRemote("set_board", self.localBoard).addCallback(self.boardSet)
 
     def boardSet(self, *a):
+        self.listener = GameEvents(self)
+        self.server.game.callRemote("subscribe", self.listener).addCallbacks(self.subscribed, self.showFailure)
+
+    def subscribed(self, status):
         self.showReadyMenu()
 
     def showReadyMenu(self):
@@ -383,19 +407,15 @@ class Game:
         self.server.player.callRemote("set_ready").addCallback(self.playerReady)
 
     def playerReady(self, *a):
+        print "waiting for the other players..."
+
+    def gameStarted(self, side):
         print "getting other players' names..."
-        self.server.game.callRemote("players").addCallback(self.gotPlayers)
+        self.server.game.callRemote("players").addCallback(self.gotPlayers, side)
 
-    def gotPlayers(self, plys):
+    def gotPlayers(self, plys, side):
         self.players = plys
-        print "getting board side..."
-        self.getSide()
-
-    def getSide(self):
-        self.server.game.callRemote("get_side").addCallbacks(self.gotSide, self.cannotGetSide)
-
-    def cannotGetSide(self, f):
-        reactor.callLater(.5, self.getSide)
+        self.gotSide(side)
 
     def gotSide(self, side):
         print "building the board..."
@@ -451,37 +471,20 @@ class Game:
                     print "clickeada la pieza...", self.picked
                     if hasattr(self.picked, "id"):
                         if self.onHand is None:
-                            def gotPiece(result, piece):
-                                print "Fue levantada la pieza...", piece
-                                self.onHand = piece
-                            def noPiece(failure, *a):
-                                print failure, failure.getErrorMessage(), failure.type, a
-                                # failure.trap...
-
-                            stack = self.localBoard.board[self.picked.position]
+                            piece = self.picked
+                            stack = self.localBoard.board[piece.position]
                             if len(stack) == 1:
-                                d=self.server.player.callRemote("pick", self.picked.position)
+                                d=self.server.player.callRemote("pick", piece.position)
                             else:
-                                d=self.server.player.callRemote("mine", self.picked.position, self.picked.id)
-                            d.addCallbacks(gotPiece, noPiece, [self.picked])
-
+                                d=self.server.player.callRemote("mine", piece.position, piece.id)
+                            self.predict(d, piece)
                         else:
-                            def pieceCapped(result, *a):
-                                print "capped!", result, a
-                                self.onHand = None
-                            def cannotCap(failure):
-                                print "cannot cap!"
                             print "capping..."
                             d=self.server.player.callRemote("cap", self.picked.position)
-                            d.addCallback(pieceCapped, cannotCap)
-                    elif hasattr(self.picked, "position"):
-                        def pieceDropped(result):
-                            print "Soltada la pieza...", result
-                            self.onHand = None
-                        def cannotDrop(failure):
-                            print "No se puede soltar la pieza...", failure
+                            self.predict(d, self.onHand, self.picked.position)
+                    elif hasattr(self.picked, "position") and self.onHand is not None:
                         d=self.server.player.callRemote("drop", self.picked.position)
-                        d.addCallbacks(pieceDropped, cannotDrop)
+                        self.predict(d, self.onHand, self.picked.position)
             elif event.button == 4:
                 self.newPosition = event.pos
                 self.gameGroup.angle -= 5
@@ -489,6 +492,44 @@ class Game:
                 self.newPosition = event.pos
                 self.gameGroup.angle += 5
 
+    def predict(self, d, piece, where=None):
+        """
+        shows the move d is waiting for as made, with the piece in hand 
+        when where is None, and takes it back if the server rejects it
+        """
+        prediction = self.localBoard.predict(piece.id, where)
+        if where is None:
+            self.onHand = piece
+        else:
+            self.onHand = None
+        def confirmed(seq):
+            self.localBoard.confirm(prediction, seq)
+        def rejected(failure):
+            print "move rejected:", failure.getErrorMessage()
+            self.localBoard.reject(prediction)
+            if where is None:
+                # the pick or mine failed, the piece is not ours
+                self.onHand = None
+                onBoard = [ s for s in self.localBoard.board.values() 
+                                if piece.id in s ]
+                if onBoard:
+                    self.rollingBack.add(piece)
+            else:
+                # the cap or drop failed, the piece is still in our hand
+                self.onHand = piece
+        d.addCallbacks(confirmed, rejected)
+
+    def place(self, piece, translate):
+        """ moves a rolled back piece part of the way to translate """
+        if piece in self.rollingBack:
+            current = tuple(piece.translate)
+            step = [ t - c for c, t in zip(current, translate) ]
+            if max([ abs(s) for s in step ]) > 0.05:
+                translate = tuple([ c + s*ROLLBACK_STEP for c, s in zip(current, step) ])
+            else:
+                self.rollingBack.discard(piece)
+        piece.translate = translate
+
     #the main render loop
     def loop(self):
         side = self.localBoard.side
@@ -507,7 +548,7 @@ class Game:
                     if lastscale != 0:
                         y += 3*(lastscale - scale) + 0.4
 
-                    piece.translate = (x-side/2 + ((z%2)*0.5+0.25))*4, -1+scale + y, (z+0.5-side/2)*3.5777087639996634
+                    self.place(piece, ((x-side/2 + ((z%2)*0.5+0.25))*4, -1+scale + y, (z+0.5-side/2)*3.5777087639996634))
                     lastscale = scale
 
         self.newPosition = None
@@ -539,6 +580,7 @@ class Game:
             mx, my = self.newPosition
             ray = selection.generateSelectionRay( mx, WINDOW_SIZE[1]-my, self.viewport.screen_dimensions, modelview, projection )
             point = self.boardPlane.intersect(ray)
+            self.rollingBack.discard(self.onHand)
             if point is not None:
                 x, y, z = point
                 scale = self.onHand.scale[0]
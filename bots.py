@@ -0,0 +1,341 @@
+"""
+Bots that play from inside the server.
+
+A bot chooses its moves with a Monte Carlo search: it tries each of its
+legal moves, plays the rest out with random moves by random players for
+PLAYOUT_MOVES moves, and spends more playouts on the moves that have done
+best so far (UCB1) until its time budget is used. Playouts are made on a 
+copy of the game from snapshot.decode and taken back with Board.undo_to, 
+so a search only needs the encoded game and can run in another thread or 
+spread over a process pool, each process searching on its own and the 
+visits added up.
+
+A bot passes once every other player that is not a bot has passed or left,
+so the game can end, and leaves when only bots remain.
+
+Run this module to pit a bot against random players and see how many
+decisions and simulated moves per second it makes.
+
+    python bots.py --games 10 --players 2 --budget 0.1 --processes 4
+"""
+import time, random, math
+import multiprocessing
+from optparse import OptionParser
+import unittest
+import model, snapshot
+
+BUDGET = 0.2
+PLAYOUT_MOVES = 4
+EXPLORATION = 1.4
+THINK_DELAY = 0.5
+
+pool = None
+workers = 1
+
+def start_pool(processes):
+    """ the process pool bots search in from now on """
+    global pool, workers
+    pool = multiprocessing.Pool(processes)
+    workers = processes
+
+def clone(game):
+    """ a copy of the game that can be played on without side effects """
+    return load(snapshot.encode(game))
+
+def load(data):
+    game = snapshot.decode(data)
+    game.log = None
+    return game
+
+def by_code(game, code):
+    for p in game.players:
+        if p.code == code:
+            return p
+    raise model.GameError("No player %r"%(code,))
+
+def move_ids(move):
+    """ the move with piece ids instead of pieces """
+    return tuple( a.id if isinstance(a, model.Piece) else a for a in move )
+
+def move_pieces(board, move):
+    """ the move with the board's pieces instead of ids """
+    if move[0] in ("split", "mine"):
+        move = move[:2] + (board.piece_map[move[2]],) + move[3:]
+    return move
+
+def make(player, move):
+    getattr(player, move[0])(*move_pieces(player.game.board, move)[1:])
+
+def playout(board, players, rnd, moves=PLAYOUT_MOVES):
+    """ random moves by random players, how many were made """
+    made = 0
+    for i in range(moves):
+        player = rnd.choice(players)
+        options = board.legal_moves(player)
+        if options:
+            board.make(player, rnd.choice(options))
+            made += 1
+    return made
+
+def evaluate(board, player):
+    """ how far ahead of the best other player, between -1 and 1 """
+    scores = board.scores
+    others = [ scores[p] for p in board.players if p is not player ]
+    lead = scores[player] - max(others or [0])
+    return lead / (1.0 + abs(lead))
+
+def search(data, code, budget, seed=None):
+    """
+    ({move: [visits, total value]}, moves simulated) for the moves of the
+    player with that code in the encoded game, moves with piece ids. With
+    more moves than the budget allows playouts for, only some are tried
+    """
+    rnd = random.Random(seed)
+    game = load(data)
+    board = game.board
+    player = by_code(game, code)
+    legal = board.legal_moves(player)
+    moves = [ move_ids(m) for m in legal ]
+    by_ids = dict(zip(moves, legal))
+    rnd.shuffle(moves)
+    playing = [ p for p in game.players if p.status == p.STATUS_PLAYING ]
+    hands = [ p.on_hand for p in game.players ]
+    board.start_undo()
+    stats = {}
+    simulated = 0
+    deadline = time.time() + budget
+    visits = 0
+    while moves and (not visits or time.time() < deadline):
+        if visits < len(moves):
+            move = moves[visits]
+            stats[move] = [0, 0.0]
+        else:
+            log_visits = math.log(visits)
+            move = max(moves, key=lambda m: stats[m][1] / stats[m][0] +
+                        EXPLORATION * math.sqrt(log_visits / stats[m][0]))
+        board.make(player, by_ids[move])
+        simulated += 1 + playout(board, playing, rnd)
+        stats[move][0] += 1
+        stats[move][1] += evaluate(board, player)
+        board.undo_to(0)
+        for p, hand in zip(game.players, hands):
+            p.on_hand = hand
+        visits += 1
+    return stats, simulated
+
+def search_task(args):
+    return search(*args)
+
+def choose(data, code, budget=BUDGET, pool=None, workers=1):
+    """ (move with piece ids or None, moves simulated) """
+    if pool is None:
+        results = [ search(data, code, budget) ]
+    else:
+        tasks = [ (data, code, budget, random.random()) for i in range(workers) ]
+        results = pool.map(search_task, tasks)
+    totals = {}
+    simulated = 0
+    for stats, count in results:
+        simulated += count
+        for move, (visits, value) in stats.items():
+            total = totals.setdefault(move, [0, 0.0])
+            total[0] += visits
+            total[1] += value
+    if not totals:
+        return None, simulated
+    return max(totals, key=lambda m: totals[m][0]), simulated
+
+class Bot:
+    """ plays a model.Player, thinking in a thread between reactor turns """
+    def __init__(self, player, budget=BUDGET, delay=THINK_DELAY):
+        self.player = player
+        player.bot = self
+        self.budget = budget
+        self.delay = delay
+        self.moves = 0
+        self.simulated = 0
+        self.thinking = 0.0
+
+    def start(self):
+        from twisted.internet import reactor
+        reactor.callLater(self.delay, self.think)
+
+    def humans(self):
+        """ the players that are not bots and have not left """
+        return [ p for p in self.player.game.players 
+                    if p.bot is None and p.status != p.STATUS_LEFT ]
+
+    def think(self):
+        from twisted.internet import threads
+        game, player = self.player.game, self.player
+        if game.status == game.STATUS_DONE or \
+                player.status in (player.STATUS_LEFT, player.STATUS_DONE):
+            return
+        if not self.humans():
+            return player.leave()
+        if game.status != game.STATUS_PLAYING or \
+                player.status != player.STATUS_PLAYING:
+            return self.start()
+        if player.on_hand is None and not [ p for p in self.humans()
+                                            if p.status != p.STATUS_PASS ]:
+            return player.pass_move()
+        d = threads.deferToThread(self.timed_choose, snapshot.encode(game))
+        d.addCallback(self.play)
+        d.addErrback(game.errback)
+        d.addBoth(lambda _: self.start())
+
+    def timed_choose(self, data):
+        started = time.time()
+        result = choose(data, self.player.code, self.budget, pool, workers)
+        self.thinking += time.time() - started
+        return result
+
+    def play(self, result):
+        """ makes the move unless the game changed so it is not legal now """
+        move, simulated = result
+        self.simulated += simulated
+        if move is None:
+            return
+        try:
+            make(self.player, move)
+            self.moves += 1
+        except model.GameError:
+            pass
+
+    def stats(self):
+        thinking = self.thinking or 1e-9
+        return {"moves": self.moves, "thinking": self.thinking,
+                "moves_per_second": self.moves / thinking,
+                "simulated_per_second": self.simulated / thinking}
+
+### BENCHMARK ###
+
+def match(num_players, budget, seed, max_moves, pool=None, workers=1):
+    """ one game of a bot, the first player, against random players """
+    model.VERBOSE = False
+    rnd = random.Random(seed)
+    game = model.game_for(num_players, seed=seed)
+    game.log = None
+    bot = game.players[0]
+    decisions = simulated = 0
+    thinking = 0.0
+    for i in range(max_moves):
+        playing = [ p for p in game.players if p.status == p.STATUS_PLAYING ]
+        if not playing:
+            break
+        player = rnd.choice(playing)
+        if player is bot:
+            started = time.time()
+            move, count = choose(snapshot.encode(game), bot.code, budget,
+                                 pool, workers)
+            thinking += time.time() - started
+            decisions += 1
+            simulated += count
+            if move is not None:
+                make(bot, move)
+        else:
+            moves = game.board.legal_moves(player)
+            if moves:
+                move = rnd.choice(moves)
+                getattr(player, move[0])(*move[1:])
+    return game.leader() is bot, decisions, simulated, thinking
+
+def run(options):
+    bot_pool = None
+    if options.processes:
+        bot_pool = multiprocessing.Pool(options.processes)
+    wins = decisions = simulated = 0
+    thinking = 0.0
+    for seed in range(options.games):
+        won, d, s, t = match(options.players, options.budget, seed,
+                             options.max_moves, bot_pool, options.processes)
+        wins += won
+        decisions += d
+        simulated += s
+        thinking += t
+    print "games:", options.games, "bot wins:", wins
+    print "bot decisions per second: %.1f" % (decisions / thinking)
+    print "simulated moves per second: %.0f" % (simulated / thinking)
+
+### TESTS ###
+
+class TestBots(unittest.TestCase):
+    def setUp(self):
+        self.verbose = model.VERBOSE
+        model.VERBOSE = False
+
+    def tearDown(self):
+        model.VERBOSE = self.verbose
+
+    def testclone(self):
+        game = model.play_randomly(model.game_for(3, seed=1), 20, random.Random(1))
+        copied = clone(game)
+        self.assertEqual(copied.get_board_map(), game.get_board_map())
+        make(copied.players[0], move_ids(copied.board.legal_moves(copied.players[0])[0]))
+        self.assertNotEqual(copied.seq, game.seq)
+
+    def testsearch(self):
+        game = model.game_for(2, seed=2)
+        player = game.players[0]
+        data = snapshot.encode(game)
+        stats, simulated = search(data, player.code, 0.05, seed=0)
+        legal = [ move_ids(m) for m in game.board.legal_moves(player) ]
+        self.assertTrue(stats)
+        self.assertEqual([ m for m in stats if not m in legal ], [])
+        self.assertTrue(min([ v for v, total in stats.values() ]) >= 1)
+        stats, simulated = search(data, player.code, 0, seed=0)
+        self.assertEqual(len(stats), 1)
+        self.assertTrue(simulated > 0)
+
+        move, simulated = choose(data, player.code, 0.01)
+        self.assertTrue(move in legal)
+        make(player, move)
+
+    def testblocked(self):
+        game = model.game_for(2, seed=3)
+        for p in game.players:
+            p.pass_move()
+        self.assertEqual(choose(snapshot.encode(game), "a", 0.01)[0], None)
+
+    def testfinish(self):
+        game = model.game_for(3, seed=4)
+        human = game.players[0]
+        bots = [ Bot(p, 0.01) for p in game.players[1:] ]
+        rnd = random.Random(4)
+        def human_move():
+            moves = game.board.legal_moves(human)
+            if moves and human.status == human.STATUS_PLAYING:
+                move = rnd.choice(moves)
+                getattr(human, move[0])(*move[1:])
+        for i in range(5):
+            human_move()
+            for bot in bots:
+                bot.play(bot.timed_choose(snapshot.encode(game)))
+        while human.on_hand is not None:
+            human_move()
+        self.assertTrue(bots[0].moves)
+        human.pass_move()
+        for bot in bots:
+            while bot.player.on_hand is not None:
+                bot.play(bot.timed_choose(snapshot.encode(game)))
+            bot.think()
+        self.assertEqual(game.status, game.STATUS_DONE)
+
+    def testleave(self):
+        game = model.game_for(3, seed=5)
+        bots = [ Bot(p, 0.01) for p in game.players[1:] ]
+        game.players[0].leave()
+        for bot in bots:
+            bot.think()
+        self.assertEqual(game.status, game.STATUS_DONE)
+        self.assertEqual(game.server.games(), [])
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("--games", type="int", default=10)
+    parser.add_option("--players", type="int", default=2)
+    parser.add_option("--budget", type="float", default=0.1)
+    parser.add_option("--processes", type="int", default=0)
+    parser.add_option("--max-moves", type="int", default=400)
+    options, args = parser.parse_args()
+    run(options)
@@ -5,9 +5,13 @@ from twisted.python import util
 import time, sys
 import threading
 import Queue
+import snapshot
+import model
 
 class ClientError(Exception): pass
 
+PAGE = 20
+
 def waitFor(func, *args, **kwargs):
     queue = Queue.Queue()
 
@@ -30,17 +34,110 @@ def Error(reason):
     d.errback(reason)
     return d
         
+class Prediction:
+    """ a move shown before the server answers it """
+    def __init__(self, piece, where):
+        self.piece = piece
+        self.where = where
+        self.seq = None
+
 class RemoteBoard(pb.Referenceable):
+    """
+    The board as the server sends it. board is what to show: the server's 
+    board, confirmed, with the moves predict() was told about on top until 
+    the server's board includes them or they fail.
+    """
     def __init__(self):
         self.board = None
+        self.confirmed = None
+        self.predictions = []
         self.pieces = None
         self.on_hand_all = None
         self.on_hand = None
         self.side = None
+        self.seq = None
+        self.resyncing = False
+        
+    def remote_set_board(self, board, seq=None):
+        self.confirmed = board
+        self.seq = seq
+        self.resyncing = False
+        self.reconcile()
+        
+    def remote_patch_board(self, seq, delta, base=None):
+        """ 
+        delta takes the board from seq base, seq-1 by default, to seq. 
+        returns True when a full set_board is needed 
+        """
+        if base is None:
+            base = seq - 1
+        if self.confirmed is None or self.seq is None or base != self.seq:
+            if self.resyncing:
+                return False
+            self.resyncing = True
+            return True
+        for where, stack in delta.items():
+            if stack:
+                self.confirmed[where] = stack
+            elif where in self.confirmed:
+                del self.confirmed[where]
+        self.seq = seq
+        self.reconcile()
+        return False
+        
+    def predict(self, piece, where=None):
+        """
+        shows the piece at the top of where, or off the board when where is
+        None, as picking, mining, capping or dropping it will. Tell 
+        confirm() the seq the move answers or reject() that it failed
+        """
+        prediction = Prediction(piece, where)
+        self.predictions.append(prediction)
+        self.show()
+        return prediction
+        
+    def confirm(self, prediction, seq):
+        prediction.seq = seq
+        self.reconcile()
         
-    def remote_set_board(self, board):
+    def reject(self, prediction):
+        if prediction in self.predictions:
+            self.predictions.remove(prediction)
+            self.show()
+        
+    def reconcile(self):
+        """ forgets the predictions the server's board has caught up with """
+        if self.seq is not None:
+            self.predictions = [ p for p in self.predictions 
+                                    if p.seq is None or p.seq > self.seq ]
+        self.show()
+        
+    def show(self):
+        if not self.predictions or self.confirmed is None:
+            self.board = self.confirmed
+            return
+        board = dict(self.confirmed)
+        for p in self.predictions:
+            for where, stack in board.items():
+                if p.piece in stack:
+                    stack = [ id for id in stack if id != p.piece ]
+                    if stack:
+                        board[where] = stack
+                    else:
+                        del board[where]
+            if p.where is not None:
+                board[p.where] = board.get(p.where, []) + [p.piece]
         self.board = board
         
+    def remote_set_snapshot(self, data):
+        """ what spectators get instead of set_board and patch_board """
+        game = snapshot.decode(data)
+        self.seq = game.seq
+        if game.board is not None:
+            self.pieces = game.get_piece_map()
+            self.confirmed = self.board = game.get_board_map()
+            self.side = game.board.side
+        
     def remote_set_pieces(self, pieces):
         self.pieces = pieces
         
@@ -48,6 +145,10 @@ class RemoteBoard(pb.Referenceable):
         self.on_hand_all = all
         self.on_hand = mine
         
+    def hash(self):
+        """ what NetworkGame.get_hash says for the same seq """
+        return model.board_hash(self.confirmed or {})
+        
     def dump(self):
         if not self.board: return
         for where, stack in self.board.items():
@@ -57,6 +158,37 @@ class RemoteBoard(pb.Referenceable):
             print "]"
         sys.stdout.flush()
                 
+class GameListener(pb.Referenceable):
+    """ game events for NetworkGame.subscribe, override the ones you need """
+    def remote_player_joined(self, name):
+        pass
+        
+    def remote_player_ready(self, name):
+        pass
+        
+    def remote_game_started(self, side):
+        pass
+        
+    def remote_game_finished(self, standings, winner):
+        pass
+        
+class QueueListener(GameListener):
+    """ puts (event, args) in a Queue for other threads """
+    def __init__(self):
+        self.events = Queue.Queue()
+        
+    def remote_player_joined(self, name):
+        self.events.put( ("player_joined", (name,)) )
+        
+    def remote_player_ready(self, name):
+        self.events.put( ("player_ready", (name,)) )
+        
+    def remote_game_started(self, side):
+        self.events.put( ("game_started", (side,)) )
+        
+    def remote_game_finished(self, standings, winner):
+        self.events.put( ("game_finished", (standings, winner)) )
+        
 class CrystalClient:
     def __init__(self, server_host, server_port=9091):
         self.server_host = server_host
@@ -104,9 +236,12 @@ class GameCmd(cmd.Cmd):
         cmd.Cmd.__init__(self)
         
     def do_games(self, rest):
-        games = waitFor(self.server.callRemote, "games")
-        for i, game in enumerate(games):
-            print i,":", waitFor(game.callRemote, "name")
+        page = int(rest or 0)
+        total, games = waitFor(self.server.callRemote, "list_games", 
+                               page*PAGE, PAGE)
+        for id, name, status, players in games:
+            print id,":", name, status, players, "players"
+        print "page", page, "of", (total - 1) // PAGE
 
             
     def do_create(self, rest):
@@ -130,33 +265,100 @@ class GameCmd(cmd.Cmd):
         if self.current:
             print "not while inside a game"
             return
-        game = waitFor(self.server.callRemote, "games")[ what ]
+        game = waitFor(self.server.callRemote, "get_game", what)
         self.player = waitFor(game.callRemote, "join", self.username)
         self.current = game
         
+    def do_watch(self, rest):
+        if self.current:
+            print "not while inside a game"
+            return
+        game = waitFor(self.server.callRemote, "get_game", int(rest))
+        waitFor(game.callRemote, "watch", self.board)
+        self.current = game
+        self.callback(self.server, self.current, None, self.board)
+        
     def do_ready(self, rest):
         if not self.current:
             print "must be in game"
             return
         
         waitFor(self.player.callRemote, "set_board", self.board)
+        listener = QueueListener()
+        game, players = waitFor(self.current.callRemote, "subscribe", listener)
+        print "Game Status:", game
+        print "Player Status:"
+        for pl,st in players:
+            print "\t", pl,":", st
             
         waitFor(self.player.callRemote, "set_ready")
-        done = False
-        while not done:
-            game, players = waitFor(self.current.callRemote, "player_status")
-            if game=="STATUS_PLAYING":
-                done = True
-                break
-            print "-"*20
-            print "Game Status:", game
-            print "Player Status:"
-            for pl,st in players:
-                print "\t", pl,":", st
-            time.sleep(2)
+        while game != "STATUS_PLAYING":
+            event, args = listener.events.get()
+            print event, " ".join([ str(a) for a in args ])
+            if event == "game_started":
+                game = "STATUS_PLAYING"
+        waitFor(self.current.callRemote, "unsubscribe", listener)
         self.callback(self.server, self.current, self.player, self.board)
-        
-        
+
+### TESTS ###
+
+import unittest
+
+class TestPrediction(unittest.TestCase):
+    def setUp(self):
+        self.verbose = model.VERBOSE
+        model.VERBOSE = False
+        self.game = model.game_for(2)
+        self.player = self.game.players[0]
+        self.remote = model.StubRemote()
+        self.player.remote_board = self.remote
+        self.board = RemoteBoard()
+        self.game.send_to(self.player)
+        self.deliver()
+
+    def tearDown(self):
+        model.VERBOSE = self.verbose
+
+    def deliver(self):
+        """ what the game sent to the player so far """
+        calls, self.remote.calls = self.remote.calls, []
+        for call in calls:
+            getattr(self.board, "remote_" + call[0])(*call[1:])
+
+    def lone(self):
+        return [ (w, s[0]) for w, s in self.board.board.items()
+                    if len(s) == 1 and
+                       self.board.pieces[s[0]][0] == self.player.name ][0]
+
+    def testconfirm(self):
+        where, piece = self.lone()
+        prediction = self.board.predict(piece)
+        self.assertFalse(where in self.board.board)
+        self.assertTrue(where in self.board.confirmed)
+
+        self.player.pick(where)
+        self.deliver()
+        self.assertFalse(where in self.board.board)
+        self.board.confirm(prediction, self.game.seq)
+        self.assertEqual(self.board.predictions, [])
+
+        prediction = self.board.predict(piece, where)
+        self.player.drop(where)
+        self.board.confirm(prediction, self.game.seq)
+        self.assertEqual(self.board.board[where], [piece])
+        self.deliver()
+        self.assertEqual(self.board.board[where], [piece])
+        self.assertTrue(self.board.board is self.board.confirmed)
+        self.assertEqual(self.board.hash(), self.game.board.zobrist)
+
+    def testreject(self):
+        where, piece = self.lone()
+        before = dict(self.board.board)
+        prediction = self.board.predict(piece)
+        self.board.reject(prediction)
+        self.assertEqual(self.board.board, before)
+
+
 if __name__ == "__main__":
     test = 0
     try:
@@ -0,0 +1,396 @@
+"""
+Compact board engine.
+
+CompactBoard works like model.Board (board[(x,y)], place, pick, split and
+iterating over the stacks) but keeps the game in flat arrays instead of a 
+dict of lists:
+
+    owner[id], size[id]     player index and size of every piece
+    cell[id]                cell the piece is on, EMPTY when off the board
+    below[id]               piece under it in its stack, EMPTY at the bottom
+    top_of[cell]            top piece of every cell, EMPTY when there is none
+    heights[cell]           pieces on every cell
+
+hashes holds the 64 bit hash of every cell's stack as two 32 bit halves,
+low first. .tops and .empty are Tops and Empty, two arrays with the top piece and the
+height of every cell as of its last change, which is what Board.tally()
+needs to take back the counts of the stack that was there.
+
+cells are numbered x*side + y. Stacks handed out by board[(x,y)] are built
+on demand and changing them does not change the board.
+
+Run this module to compare the memory used by both engines.
+"""
+import sys
+from array import array
+import model
+from model import GameError
+
+EMPTY = -1
+
+class Tops:
+    """ Board.tops, kept in arrays indexed by cell """
+    def __init__(self, board, cells):
+        self.board = board
+        self.ids = array("i", [EMPTY]) * cells
+        self.heights = array("H", [0]) * cells
+        self.count = 0
+        
+    def set(self, cell, id, height):
+        self.count += (id != EMPTY) - (self.ids[cell] != EMPTY)
+        self.ids[cell] = id
+        self.heights[cell] = height
+        
+    def entry(self, cell):
+        piece = self.board.piece_map[self.ids[cell]]
+        return (piece.player, piece.size, self.heights[cell])
+        
+    def __contains__(self, position):
+        cell = self.board.cell_for(position)
+        return cell is not None and self.ids[cell] != EMPTY
+        
+    def __getitem__(self, position):
+        if not position in self:
+            raise KeyError(position)
+        return self.entry(self.board.cell_for(position))
+        
+    def __len__(self):
+        return self.count
+        
+    def __iter__(self):
+        for cell, id in enumerate(self.ids):
+            if id != EMPTY:
+                yield self.board.position_for(cell)
+                
+    def keys(self):
+        return list(self)
+        
+    def iteritems(self):
+        for cell, id in enumerate(self.ids):
+            if id != EMPTY:
+                yield self.board.position_for(cell), self.entry(cell)
+                
+class Empty:
+    """ Board.empty, the cells Tops has nothing for """
+    def __init__(self, tops):
+        self.tops = tops
+        
+    def __contains__(self, position):
+        cell = self.tops.board.cell_for(position)
+        return cell is not None and self.tops.ids[cell] == EMPTY
+        
+    def __len__(self):
+        return len(self.tops.ids) - self.tops.count
+        
+    def __iter__(self):
+        for cell, id in enumerate(self.tops.ids):
+            if id == EMPTY:
+                yield self.tops.board.position_for(cell)
+
+class CompactBoard(model.Board):
+    def setup(self, side, pieces):
+        self.index = dict( (p, i) for i, p in enumerate(self.players) )
+        self.owner = array("H")
+        self.size = array("B")
+        self.cell = array("i")
+        self.below = array("i")
+        self.top_of = array("i", [EMPTY]) * (side*side)
+        self.heights = array("H", [0]) * (side*side)
+        self.hashes = array("I", [0]) * (2*side*side)
+        self.tops = Tops(self, side*side)
+        self.empty = Empty(self.tops)
+        
+    def add_piece(self, player, size):
+        piece = model.Board.add_piece(self, player, size)
+        self.owner.append(self.index[player])
+        self.size.append(size)
+        self.cell.append(EMPTY)
+        self.below.append(EMPTY)
+        return piece
+        
+    def cell_for(self, position):
+        x, y = position
+        if 0 <= x < self.side and 0 <= y < self.side:
+            return x*self.side + y
+        return None
+        
+    def position_for(self, cell):
+        return divmod(cell, self.side)
+        
+    def ids(self, cell):
+        result = []
+        id = self.top_of[cell]
+        while id != EMPTY:
+            result.append(id)
+            id = self.below[id]
+        result.reverse()
+        return result
+        
+    def _link(self, cell, id):
+        self.below[id] = self.top_of[cell]
+        self.top_of[cell] = id
+        self.cell[id] = cell
+        self.heights[cell] += 1
+        
+    def _clear(self, cell):
+        id = self.top_of[cell]
+        while id != EMPTY:
+            below = self.below[id]
+            self.below[id] = EMPTY
+            self.cell[id] = EMPTY
+            id = below
+        self.top_of[cell] = EMPTY
+        self.heights[cell] = 0
+        
+    def stack_hash_at(self, position):
+        cell = self.cell_for(position)
+        if cell is None:
+            return 0
+        return self.hashes[2*cell] | self.hashes[2*cell+1] << 32
+        
+    def set_stack_hash(self, position, value):
+        cell = self.cell_for(position)
+        if cell is not None:
+            self.hashes[2*cell] = value & 0xffffffff
+            self.hashes[2*cell+1] = value >> 32
+        
+    def set_top(self, position, top):
+        cell = self.cell_for(position)
+        if cell is None:
+            return
+        if top is None:
+            self.tops.set(cell, EMPTY, 0)
+        else:
+            self.tops.set(cell, top.id, self.heights[cell])
+        
+    def _board_cell(self, position):
+        cell = self.cell_for(position)
+        if cell is None:
+            raise GameError("Position is not on the board")
+        return cell
+        
+    def __getitem__(self, key):
+        cell = self.cell_for(key)
+        if cell is None or self.top_of[cell] == EMPTY:
+            return None
+        piece_map = self.piece_map
+        return [ piece_map[id] for id in self.ids(cell) ]
+        
+    def __setitem__(self, key, value):
+        cell = self._board_cell(key)
+        self._clear(cell)
+        for piece in value:
+            self._link(cell, piece.id)
+        self.touched(key)
+        
+    def __delitem__(self, key):
+        if not key in self:
+            raise KeyError(key)
+        self._clear(self.cell_for(key))
+        self.touched(key)
+        
+    def __contains__(self, key):
+        cell = self.cell_for(key)
+        return cell is not None and self.top_of[cell] != EMPTY
+        
+    def __iter__(self):
+        piece_map = self.piece_map
+        for cell, top in enumerate(self.top_of):
+            if top != EMPTY:
+                stack = [ piece_map[id] for id in self.ids(cell) ]
+                yield self.position_for(cell), stack
+                
+    def height(self, position):
+        cell = self.cell_for(position)
+        if cell is None:
+            return 0
+        return self.heights[cell]
+        
+    def top(self, position):
+        cell = self.cell_for(position)
+        if cell is None or self.top_of[cell] == EMPTY:
+            return None
+        return self.piece_map[self.top_of[cell]]
+        
+    def _push(self, position, piece):
+        self._link(self._board_cell(position), piece.id)
+        
+    def _remove(self, where, piece):
+        cell = self._board_cell(where)
+        id = piece.id
+        if self.cell[id] != cell:
+            raise GameError("Piece not there to pick up")
+            
+        above = EMPTY
+        current = self.top_of[cell]
+        while current != id:
+            above = current
+            current = self.below[current]
+            
+        if above == EMPTY:
+            self.top_of[cell] = self.below[id]
+        else:
+            self.below[above] = self.below[id]
+        self.below[id] = EMPTY
+        self.cell[id] = EMPTY
+        self.heights[cell] -= 1
+        
+    def _split(self, where_from, piece, where_to):
+        cell_from = self._board_cell(where_from)
+        cell_to = self._board_cell(where_to)
+        id = piece.id
+        if self.cell[id] != cell_from:
+            raise GameError("Piece is not There")
+        self._clear(cell_to)
+        
+        moved = 1
+        current = self.top_of[cell_from]
+        while current != id:
+            self.cell[current] = cell_to
+            current = self.below[current]
+            moved += 1
+        self.cell[id] = cell_to
+        
+        self.top_of[cell_to] = self.top_of[cell_from]
+        self.top_of[cell_from] = self.below[id]
+        self.below[id] = EMPTY
+        self.heights[cell_to] = moved
+        self.heights[cell_from] -= moved
+        
+    def _insert(self, position, index, piece):
+        cell = self._board_cell(position)
+        id = piece.id
+        above = EMPTY
+        current = self.top_of[cell]
+        for i in range(self.heights[cell] - index):
+            above = current
+            current = self.below[current]
+            
+        self.below[id] = current
+        if above == EMPTY:
+            self.top_of[cell] = id
+        else:
+            self.below[above] = id
+        self.cell[id] = cell
+        self.heights[cell] += 1
+        
+    def _join(self, where_from, where_to):
+        cell_from = self._board_cell(where_from)
+        cell_to = self._board_cell(where_to)
+        current = self.top_of[cell_to]
+        while True:
+            self.cell[current] = cell_from
+            if self.below[current] == EMPTY:
+                break
+            current = self.below[current]
+        self.below[current] = self.top_of[cell_from]
+        
+        self.top_of[cell_from] = self.top_of[cell_to]
+        self.top_of[cell_to] = EMPTY
+        self.heights[cell_from] += self.heights[cell_to]
+        self.heights[cell_to] = 0
+        
+        
+### MEMORY ###
+
+def sizeof(obj, seen=None):
+    """ 
+    bytes used by obj and everything it references, players and games
+    are shared by both engines so they are not counted
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, (model.Player, model.Game, type)):
+        return 0
+    seen.add(id(obj))
+    
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += sizeof(key, seen) + sizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += sizeof(item, seen)
+    if hasattr(obj, "__dict__"):
+        size += sizeof(obj.__dict__, seen)
+    for slot in getattr(type(obj), "__slots__", ()):
+        if hasattr(obj, slot):
+            size += sizeof(getattr(obj, slot), seen)
+    return size
+    
+def board_size(factory, num_players, samples=5):
+    total = 0
+    for i in range(samples):
+        game = model.game_for(num_players, board_factory=factory)
+        total += sizeof(game.board)
+    return total // samples
+    
+def compare(budget=2**30, player_counts=(2, 4, 8, 16, 24)):
+    print "%8s %12s %12s %14s %14s"%("players", "dict bytes", "compact bytes",
+                                    "dict games", "compact games")
+    for num_players in player_counts:
+        plain = board_size(model.Board, num_players)
+        compact = board_size(CompactBoard, num_players)
+        print "%8i %12i %12i %14i %14i"%(num_players, plain, compact, 
+                                    budget // plain, budget // compact)
+        
+
+if __name__ == "__main__":
+    model.VERBOSE = False
+    print "Boards per GB of server memory (board state only)"
+    compare()
+        
+### TESTS ###
+
+import unittest
+import snapshot
+
+class TestCompactUndo(model.TestUndo):
+    board_factory = CompactBoard
+    
+class TestCompactBoard(unittest.TestCase):
+    def testhash(self):
+        game = model.play_randomly(model.game_for(3, seed=4), 100)
+        data = snapshot.encode(game)
+        compact = snapshot.decode(data, model.Server(CompactBoard))
+        self.assertEqual(compact.board.position_hash(), 
+                         game.board.position_hash())
+        
+
+    def check(self, board):
+        seen = []
+        for where, stack in board:
+            cell = board.cell_for(where)
+            self.assertEqual(board.heights[cell], len(stack))
+            self.assertEqual(board.top(where), stack[-1])
+            for piece in stack:
+                self.assertEqual(board.cell[piece.id], cell)
+            seen.extend(stack)
+        on_board = [ p for p in board.piece_map if board.cell[p.id] != EMPTY ]
+        self.assertEqual(sorted(seen), sorted(on_board))
+        
+        stacks = dict(board)
+        self.assertEqual(dict(board.tops), dict( (w, (s[-1].player, 
+                            s[-1].size, len(s))) for w, s in stacks.items() ))
+        cells = set( (x, y) for x in range(board.side) 
+                            for y in range(board.side) )
+        self.assertEqual(set(board.empty), cells - set(stacks))
+        self.assertEqual(len(board.empty), len(cells) - len(stacks))
+        
+    def testmoves(self):
+        game = model.game_for(4, board_factory=CompactBoard)
+        board = game.board
+        self.check(board)
+        self.assertEqual(len(list(board)), len(board.piece_map))
+        
+        model.random_moved(game)
+        self.check(board)
+        held = [ p.on_hand for p in game.players if p.on_hand is not None ]
+        self.assertEqual(sum( len(s) for w, s in board ) + len(held), 
+                         len(board.piece_map))
+        
+    def testplace(self):
+        game = model.game_for(2, board_factory=CompactBoard)
+        board = game.board
+        self.assertRaises(GameError, board.place, (-1, 0), board.piece_map[0])
+        self.assertEqual(board[(board.side, 0)], None)
@@ -0,0 +1,233 @@
+"""
+Load test for a running server.
+
+Starts many simulated players in one process, each with its own PB
+connection. Every group of --players creates or joins a game, gets ready
+and plays random legal moves, thinking about --think ms between them, until
+the game is over or --duration seconds have passed. At the end it prints:
+
+    latency     percentiles of every remote call by method
+    lag         from a move being sent to each player's board receiving it
+    errors      failed calls by method and message; rejected moves are
+                normal when several players race for the same piece
+
+The simulated players share one process, so when it is the one using a
+whole CPU run a few of them side by side to load the server harder.
+
+    python server.py &
+    python loadtest.py --clients 400 --players 4 --duration 60
+"""
+import time, random
+from optparse import OptionParser
+from twisted.spread import pb
+from twisted.internet import reactor, defer, task
+import client
+
+PERCENTILES = (0.5, 0.9, 0.99)
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class Stats:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.sent = {}
+        self.received = []
+        self.moves = 0
+
+    def call(self, remote, name, *args):
+        """ remote.callRemote timed and counted under name """
+        started = time.time()
+        def answered(result):
+            self.latencies.setdefault(name, []).append(time.time() - started)
+            return result
+        def failed(failure):
+            key = (name, failure.getErrorMessage())
+            self.errors[key] = self.errors.get(key, 0) + 1
+            return failure
+        d = remote.callRemote(name, *args)
+        d.addCallbacks(answered, failed)
+        return d
+
+    def lags(self):
+        """ seconds from each move being sent to each board receiving it """
+        return [ when - self.sent[key] for key, when in self.received
+                    if key in self.sent ]
+
+    def report(self, took):
+        print "%-16s %7s" % ("call", "count"),
+        for p in PERCENTILES:
+            print "%8s" % ("p%g ms" % (p*100)),
+        print "%8s" % "max ms"
+        for name in sorted(self.latencies):
+            values = self.latencies[name]
+            print "%-16s %7i" % (name, len(values)),
+            for p in PERCENTILES:
+                print "%8.2f" % (percentile(values, p) * 1000),
+            print "%8.2f" % (max(values) * 1000)
+        lags = self.lags()
+        if lags:
+            print "%-16s %7i" % ("broadcast lag", len(lags)),
+            for p in PERCENTILES:
+                print "%8.2f" % (percentile(lags, p) * 1000),
+            print "%8.2f" % (max(lags) * 1000)
+        print "moves: %i in %.1f s, %.0f per second" % (self.moves, took,
+                                                       self.moves / took)
+        for (name, message), count in sorted(self.errors.items()):
+            print "error %-10s %6i  %s" % (name, count, message)
+
+class TimedBoard(client.RemoteBoard):
+    """ notes when every seq of its game arrives """
+    def __init__(self, stats):
+        client.RemoteBoard.__init__(self)
+        self.stats = stats
+        self.game_id = None
+
+    def arrived(self, seq):
+        now = time.time()
+        first = (self.seq or 0) + 1
+        for s in range(first, seq + 1):
+            self.stats.received.append( ((self.game_id, s), now) )
+
+    def remote_set_board(self, board, seq=None):
+        if seq is not None and self.seq is not None:
+            self.arrived(seq)
+        client.RemoteBoard.remote_set_board(self, board, seq)
+
+    def remote_patch_board(self, seq, delta, base=None):
+        previous = self.seq
+        want_resync = client.RemoteBoard.remote_patch_board(self, seq, delta,
+                                                            base)
+        if self.seq != previous:
+            self.seq = previous
+            self.arrived(seq)
+            self.seq = seq
+        return want_resync
+
+class Finished(client.GameListener):
+    def __init__(self):
+        self.done = defer.Deferred()
+
+    def remote_game_finished(self, standings, winner):
+        if not self.done.called:
+            self.done.callback(None)
+
+class Group:
+    """ the players of one game, so they get ready once all have joined """
+    def __init__(self, size):
+        self.id = None
+        self.waiting = []
+        self.left_to_join = size
+
+    def wait(self, ready):
+        d = defer.Deferred()
+        if ready():
+            d.callback(None)
+        else:
+            self.waiting.append(d)
+        return d
+
+    def changed(self):
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.callback(None)
+
+    def created(self, id):
+        self.id = id
+        self.changed()
+
+    def joined(self):
+        self.left_to_join -= 1
+        self.changed()
+
+class SimulatedPlayer:
+    def __init__(self, number, options, stats, group, seat):
+        self.number = number
+        self.options = options
+        self.stats = stats
+        self.group = group
+        self.seat = seat
+        self.rnd = random.Random(number)
+
+    def sleep(self):
+        delay = self.rnd.expovariate(1000.0 / self.options.think)
+        return task.deferLater(reactor, delay, lambda: None)
+
+    @defer.inlineCallbacks
+    def run(self, deadline):
+        call, options, group = self.stats.call, self.options, self.group
+        factory = pb.PBClientFactory()
+        reactor.connectTCP(options.host, options.port, factory)
+        root = yield factory.getRootObject()
+        name = "load %i" % (self.number - self.seat)
+        if self.seat == 0:
+            game = yield call(root, "create_game", name)
+            group.created((yield call(game, "id")))
+        else:
+            yield group.wait(lambda: group.id is not None)
+            game = yield call(root, "get_game", group.id)
+        player = yield call(game, "join", "player %i" % self.number)
+        board = TimedBoard(self.stats)
+        board.game_id = group.id
+        yield call(player, "set_board", board)
+        finished = Finished()
+        yield call(game, "subscribe", finished)
+        group.joined()
+        yield group.wait(lambda: not group.left_to_join)
+        yield call(player, "set_ready")
+
+        while not finished.done.called and time.time() < deadline:
+            moves = yield call(player, "legal_moves")
+            if moves:
+                move = self.rnd.choice(moves)
+                sent = time.time()
+                try:
+                    seq = yield call(player, *move)
+                    self.stats.sent[(board.game_id, seq)] = sent
+                    self.stats.moves += 1
+                except Exception:
+                    pass
+            yield self.sleep()
+        factory.disconnect()
+
+@defer.inlineCallbacks
+def run(options):
+    stats = Stats()
+    started = time.time()
+    deadline = started + options.duration
+    players = []
+    for number in range(options.clients):
+        seat = number % options.players
+        if seat == 0:
+            group = Group(min(options.players, options.clients - number))
+            if number:
+                yield task.deferLater(reactor, options.ramp / 1000.0,
+                                      lambda: None)
+        player = SimulatedPlayer(number, options, stats, group, seat)
+        players.append(player.run(deadline))
+    results = yield defer.DeferredList(players, consumeErrors=True)
+    for ok, result in results:
+        if not ok:
+            key = ("client", result.getErrorMessage())
+            stats.errors[key] = stats.errors.get(key, 0) + 1
+    stats.report(time.time() - started)
+    reactor.stop()
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("--host", default="127.0.0.1")
+    parser.add_option("--port", type="int", default=9091)
+    parser.add_option("--clients", type="int", default=100)
+    parser.add_option("--players", type="int", default=4)
+    parser.add_option("--duration", type="float", default=30.0)
+    parser.add_option("--think", type="float", default=200.0,
+                      help="mean ms between a player's moves")
+    parser.add_option("--ramp", type="float", default=10.0,
+                      help="ms between starting each game's players")
+    options, args = parser.parse_args()
+    import model
+    model.VERBOSE = False
+    reactor.callWhenRunning(run, options)
+    reactor.run()
@@ -0,0 +1,234 @@
+"""
+Server metrics.
+
+instrument() wraps every remote_ method of a class so calls to it are
+counted and timed, from the call until the answer when it answers with a
+Deferred. Errors are counted by message for GameError and ServerError
+and by class for anything else. The server also records how many players,
+listeners or spectators each broadcast went to, and counting() wraps a
+factory to count the bytes its connections send and receive.
+
+Everything adds up in current, which NetworkServer.remote_stats returns and
+server.py --stats-file dumps now and then as JSON.
+"""
+import time, bisect, json, os
+import unittest
+from twisted.spread import pb
+from twisted.internet import defer, task
+from twisted.protocols import policies
+
+# upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+FANOUT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64)
+DUMP_EVERY = 60.0
+
+class Histogram:
+    """ how many values fell under each bound, the last bucket is unbounded """
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def stats(self):
+        """ buckets are (upper bound, count), None is the unbounded one """
+        bounds = list(self.bounds) + [None]
+        return {"count": self.count, "total": self.total, "max": self.max,
+                "buckets": [ (b, c) for b, c in zip(bounds, self.counts)
+                                if c ] }
+
+class Metrics:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.calls = {}
+        self.errors = {}
+        self.latency = {}
+        self.fanout = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def call(self, name, seconds, error=None):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if not name in self.latency:
+            self.latency[name] = Histogram(LATENCY_BUCKETS)
+        self.latency[name].add(seconds)
+        if error is not None:
+            if isinstance(error, pb.Error):
+                key = str(error)
+            else:
+                key = error.__class__.__name__
+            errors = self.errors.setdefault(name, {})
+            errors[key] = errors.get(key, 0) + 1
+
+    def broadcast(self, name, receivers):
+        if not name in self.fanout:
+            self.fanout[name] = Histogram(FANOUT_BUCKETS)
+        self.fanout[name].add(receivers)
+
+    def stats(self):
+        return {"uptime": time.time() - self.started,
+                "calls": dict(self.calls),
+                "errors": dict([ (name, dict(errors))
+                                    for name, errors in self.errors.items() ]),
+                "latency": dict([ (name, h.stats())
+                                    for name, h in self.latency.items() ]),
+                "fanout": dict([ (name, h.stats())
+                                    for name, h in self.fanout.items() ]),
+                "bytes_sent": self.bytes_sent,
+                "bytes_received": self.bytes_received}
+
+current = Metrics()
+# instrumented methods running now, the ones they call are not counted
+depth = [0]
+
+def timed(name, method):
+    """ method counted and timed under name in current """
+    def remote(self, *args, **kw):
+        if depth[0]:
+            return method(self, *args, **kw)
+        started = time.time()
+        depth[0] += 1
+        try:
+            result = method(self, *args, **kw)
+        except Exception, e:
+            current.call(name, time.time() - started, e)
+            raise
+        finally:
+            depth[0] -= 1
+        if isinstance(result, defer.Deferred):
+            def answered(value):
+                current.call(name, time.time() - started)
+                return value
+            def failed(failure):
+                current.call(name, time.time() - started, failure.value)
+                return failure
+            return result.addCallbacks(answered, failed)
+        current.call(name, time.time() - started)
+        return result
+    remote.__name__ = method.__name__
+    remote.__doc__ = method.__doc__
+    return remote
+
+def instrument(*classes):
+    """ times the remote_ methods of the classes, named like Class.method """
+    for cls in classes:
+        for attr in dir(cls):
+            if not attr.startswith("remote_"):
+                continue
+            method = getattr(cls, attr)
+            if callable(method) and not hasattr(method, "instrumented"):
+                name = "%s.%s" % (cls.__name__, attr[len("remote_"):])
+                wrapped = timed(name, method.im_func)
+                wrapped.instrumented = True
+                setattr(cls, attr, wrapped)
+
+class CountingProtocol(policies.ProtocolWrapper):
+    def write(self, data):
+        current.bytes_sent += len(data)
+        policies.ProtocolWrapper.write(self, data)
+
+    def writeSequence(self, data):
+        current.bytes_sent += sum([ len(d) for d in data ])
+        policies.ProtocolWrapper.writeSequence(self, data)
+
+    def dataReceived(self, data):
+        current.bytes_received += len(data)
+        policies.ProtocolWrapper.dataReceived(self, data)
+
+def counting(factory):
+    """ factory, with the bytes its connections move added to current """
+    wrapper = policies.WrappingFactory(factory)
+    wrapper.protocol = CountingProtocol
+    return wrapper
+
+def dump(path, stats):
+    """ writes stats() as JSON, replacing path in one go """
+    partial = path + ".tmp"
+    f = open(partial, "w")
+    try:
+        json.dump(stats(), f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+    os.rename(partial, path)
+
+def start_dumping(path, stats, interval=DUMP_EVERY):
+    """ dumps stats() to path every interval seconds, returns the LoopingCall """
+    loop = task.LoopingCall(dump, path, stats)
+    loop.start(interval, now=False)
+    return loop
+
+### TESTS ###
+
+import model
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        current.reset()
+        self.verbose = model.VERBOSE
+        model.VERBOSE = False
+
+    def tearDown(self):
+        model.VERBOSE = self.verbose
+
+    def testinstrument(self):
+        class Counter:
+            def remote_add(self, value):
+                """ adds """
+                if value < 0:
+                    raise pb.Error("Negative")
+                return value + 1
+            def remote_later(self):
+                return defer.Deferred()
+            def remote_broken(self):
+                return {}[0]
+            def remote_twice(self):
+                return self.remote_add(self.remote_add(0))
+        instrument(Counter)
+        instrument(Counter)
+        counter = Counter()
+        self.assertEqual(counter.remote_add(1), 2)
+        self.assertEqual(counter.remote_add.__doc__, " adds ")
+        self.assertRaises(pb.Error, counter.remote_add, -1)
+        self.assertRaises(KeyError, counter.remote_broken)
+        d = counter.remote_later()
+        self.assertEqual(counter.remote_twice(), 2)
+        self.assertEqual(current.calls, {"Counter.add": 2,
+                                         "Counter.broken": 1,
+                                         "Counter.twice": 1})
+        d.callback(None)
+
+        stats = current.stats()
+        self.assertEqual(stats["calls"]["Counter.later"], 1)
+        self.assertEqual(stats["errors"], {"Counter.add": {"Negative": 1},
+                                           "Counter.broken": {"KeyError": 1}})
+        self.assertEqual(stats["latency"]["Counter.add"]["count"], 2)
+
+    def testbroadcast(self):
+        game = model.game_for(3)
+        game.server.on_broadcast.append(current.broadcast)
+        for p in game.players:
+            p.remote_board = model.StubRemote()
+        game.send_all()
+        where = [ w for w, s in game.board if len(s) == 1 ][0]
+        game.players[0].pick(where)
+        fanout = current.stats()["fanout"]
+        self.assertEqual(fanout["set_board"]["buckets"], [(4, 1)])
+        self.assertEqual(fanout["patch_board"]["max"], 3)
+
+    def testhistogram(self):
+        h = Histogram((1, 10))
+        for value in (0, 1, 5, 50):
+            h.add(value)
+        self.assertEqual(h.stats()["buckets"], [(1, 2), (10, 1), (None, 1)])
+        self.assertEqual(h.stats()["max"], 50)
@@ -1,12 +1,33 @@
-import random, math, string
+import random, math, string, copy, time
 import unittest
 from twisted.spread import pb
+from twisted.internet import defer
+import snapshot
 
 class GameError(pb.Error): pass
 
 PICK_EVERY_PIECE = True
 
-class Piece:
+MOVES = ("pick", "cap", "drop", "split", "mine")
+
+CHECKPOINT_EVERY = 100
+
+SPECTATOR_TICK = 0.5
+
+MAX_IN_FLIGHT = 2
+SLOW_AFTER = 5.0
+
+IDLE_PLAYER = 600.0
+IDLE_GAME = 300.0
+
+VERBOSE = True
+
+MASK64 = (1 << 64) - 1
+HAND = 0xffff
+
+class Piece(object):
+    __slots__ = ("id", "player", "size")
+    
     def __init__(self, player, size, id):
         self.id = id
         self.player = player
@@ -23,41 +44,88 @@ class Board:
     you can iterate over the board or get for each position
     board[(x,y)]
     and get a stack 
+    
+    every position whose stack changes is recorded in .changed until
+    take_changes() is called
+    
+    .tops maps every stack to (owner, size, height) of its top piece and
+    .empty holds the cells with no stack, both are kept up to date on 
+    every change and back legal_moves()
+    
+    a player controls the towers topped by one of their pieces and scores 
+    the pieces in them, .towers and .scores keep both per player
+    
+    the same way it counts what each kind of move needs (single pieces, 
+    tops by size, split points per player ...) so move_count() can tell 
+    how many moves a player has without looking at the stacks
+    
+    stacks are kept in a dict of lists; subclasses can keep them some
+    other way by overriding setup(), add_piece() and the stack primitives 
+    (top, _push, _remove, _split and the item methods), and keep .tops 
+    and .empty some other way by overriding set_top(), and the hash of 
+    every stack by overriding stack_hash_at() and set_stack_hash()
     """
-    def __init__(self, players):
+    def __init__(self, players, layout=None, seed=None):
+        """
+        layout is (side, pieces, stacks) with pieces as (player, size) in id
+        order and stacks as (position, ids) listed from the bottom up. 
+        Without one the pieces are scattered at random, the same way every
+        time for the same seed.
+        """
         self.players = players
-        self.positions = {}
-        self.piece_map = {}
-        
-        toset = [ (player, size) 
-                    for player in players
-                    for size in (1,2,3)
-                    for amount in range(5)
-                    ]
-        random.shuffle(toset)
-        pieces = len(toset)
-        side = int(math.ceil(math.sqrt(pieces*1.3)))
+        self.piece_map = []
+        self.changed = set()
+        self.version = 0
+        self.undo_stack = None
+        self.zobrist = 0
+        self.seats = dict( (p, i) for i, p in enumerate(players) )
+        
+        if layout is None:
+            rnd = random
+            if seed is not None:
+                rnd = random.Random(seed)
+            layout = scatter(players, rnd)
+        side, pieces, stacks = layout
         self.side = side
-        empty_positions = [ (x,y) 
-                            for x in range(side) 
-                            for y in range(side)
-                         ]
-        
-        piece_count = 0
-        for player, size in toset:
-            position = random.choice(empty_positions)
-            piece = Piece(player, size, piece_count)
-            self.place(position, piece)
-            self.piece_map[piece_count]=piece
-            piece_count += 1
-            empty_positions.remove(position)
+        self.setup(side, len(pieces))
+        self.towers = dict( (p, 0) for p in players )
+        self.scores = dict( (p, 0) for p in players )
+        self.placed = 0
+        self.singles = 0
+        self.own_singles = dict( (p, 0) for p in players )
+        self.top_sizes = [0, 0, 0, 0]
+        self.own_top_sizes = dict( (p, [0, 0, 0, 0]) for p in players )
+        self.splits = dict( (p, 0) for p in players )
+        self.mines = dict( (p, 0) for p in players )
+        self.tallies = {}
+        
+        for player, size in pieces:
+            self.add_piece(player, size)
+        for where, ids in stacks:
+            self[where] = [ self.piece_map[id] for id in ids ]
+        self.changed = set()
+        
+    def setup(self, side, pieces):
+        self.positions = {}
+        self.stack_hashes = {}
+        self.tops = {}
+        self.empty = set( (x,y) for x in range(side) for y in range(side) )
+        
+    def on_board(self, position):
+        x, y = position
+        return 0 <= x < self.side and 0 <= y < self.side
+        
+    def add_piece(self, player, size):
+        piece = Piece(player, size, len(self.piece_map))
+        self.piece_map.append(piece)
+        return piece
             
     def dump(self):
         total = 0
         count = 0
         print "Stacks:"
         
-        for where, stack in self.positions.items():
+        for where, stack in self:
             print where, ":", stack
             total += len(stack)
             count += 1
@@ -70,32 +138,34 @@ class Board:
         
     def __setitem__(self, key, value):
         self.positions[key] = value
+        self.touched(key)
         
     def __iter__(self):
         return self.positions.iteritems()
         
     def __delitem__(self, key):
         del self.positions[key]
+        self.touched(key)
         
     def __contains__(self, key):
         return key in self.positions
-           
-    def place(self, position, piece):
-        if not position in self.positions or self.positions[position] is None:
-            self.positions[position]=[piece]
-        else:
-            stack = self.positions[position]
-            if stack[-1].player == piece.player:
-                raise GameError("Cannot place over your pieces")
-            if stack[-1].size < piece.size:
-                raise GameError("Cannot place over smaller pieces")
         
-            stack.append( piece )
-                    
-    def pick(self, where, piece):
-        if not where in self.positions:
-            raise GameError("Cannot pick from nowhere")
+    def top(self, position):
+        stack = self.positions.get(position)
+        if stack:
+            return stack[-1]
+        return None
+        
+    def height(self, position):
+        return len(self.positions.get(position) or ())
         
+    def _push(self, position, piece):
+        if self.positions.get(position) is None:
+            self.positions[position] = [piece]
+        else:
+            self.positions[position].append(piece)
+            
+    def _remove(self, where, piece):
         stack = self.positions[where]
         
         if not piece in stack:
@@ -105,38 +175,436 @@ class Board:
         
         if not stack:
             del self.positions[where]
-        
-        return piece
             
-    def split(self, where_from, piece, where_to):
-        #print "%"*200
-        #self.dump()
+    def _split(self, where_from, piece, where_to):
         stack_from = self.positions[where_from]
         pos = stack_from.index(piece)
         self.positions[where_to] = stack_from[pos:]
         self.positions[where_from] = stack_from[:pos]
-        #print "*"*200
-        #self.dump()
-        #print "-"*100
+        
+    def _insert(self, position, index, piece):
+        """ undoes _remove, index counts from the bottom """
+        stack = self.positions.get(position)
+        if not stack:
+            self.positions[position] = [piece]
+        else:
+            stack.insert(index, piece)
+            
+    def _join(self, where_from, where_to):
+        """ undoes _split, the stack at where_to goes back on where_from """
+        moved = self.positions.pop(where_to)
+        if self.positions.get(where_from):
+            self.positions[where_from].extend(moved)
+        else:
+            self.positions[where_from] = moved
+        
+    def touched(self, position, key=None):
+        """ 
+        updates everything kept about the stack at position. key is the 
+        zobrist_key() of the only piece that came or went, when that is 
+        all that changed in the stack
+        """
+        self.changed.add(position)
+        self.version += 1
+        self.tally(position, -1)
+            
+        top = self.top(position)
+        self.set_top(position, top)
+        if top is not None:
+            self.tally(position, 1)
+        if key is None:
+            self.rehash(position)
+        else:
+            self.set_stack_hash(position, self.stack_hash_at(position) ^ key)
+            self.zobrist ^= key
+            
+    def set_top(self, position, top):
+        """ keeps .tops and .empty up to date with the stack's top piece """
+        if top is None:
+            self.tops.pop(position, None)
+            if self.on_board(position):
+                self.empty.add(position)
+        else:
+            self.tops[position] = (top.player, top.size, self.height(position))
+            self.empty.discard(position)
+            
+    def rehash(self, position):
+        """ keeps zobrist, the xor of every stack's hash, up to date """
+        old = self.stack_hash_at(position)
+        new = stack_hash(position, self[position] or ())
+        self.set_stack_hash(position, new)
+        self.zobrist ^= old ^ new
+        
+    def stack_hash_at(self, position):
+        return self.stack_hashes.get(position, 0)
+        
+    def set_stack_hash(self, position, value):
+        if value:
+            self.stack_hashes[position] = value
+        else:
+            self.stack_hashes.pop(position, None)
+        
+    def piece_key(self, position, piece):
+        """ zobrist_key() for the piece at the top of the stack at position """
+        x, y = position
+        return zobrist_key(piece.id, x, y, self.height(position) - 1)
+        
+    def position_hash(self):
+        """ 64 bit hash of the stacks and what every player has on hand """
+        result = self.zobrist
+        for player, seat in self.seats.iteritems():
+            if player.on_hand is not None:
+                result ^= zobrist_key(player.on_hand.id, HAND, seat, HAND)
+        return result
+            
+    def tally(self, position, sign):
+        """ adds (sign 1) or takes back (sign -1) the stack's counts """
+        if not position in self.tops:
+            return
+        owner, size, height = self.tops[position]
+        self.towers[owner] += sign
+        self.scores[owner] += sign*height
+        self.placed += sign*height
+        self.top_sizes[size] += sign
+        self.own_top_sizes[owner][size] += sign
+        if height == 1:
+            self.singles += sign
+            self.own_singles[owner] += sign
+            return
+            
+        if sign > 0:
+            self.tallies[position] = self.stack_moves(self[position], owner)
+        splits, mines = self.tallies[position]
+        if sign < 0:
+            del self.tallies[position]
+        for p, count in splits.iteritems():
+            self.splits[p] += sign*count
+        for p, count in mines.iteritems():
+            self.mines[p] += sign*count
+            
+    def stack_moves(self, stack, owner):
+        """ split points and pieces to mine in a stack, by player """
+        pieces = {}
+        splits = {}
+        for pos, piece in enumerate(stack):
+            pieces[piece.player] = pieces.get(piece.player, 0) + 1
+            if pos:
+                below = stack[pos-1].player
+                splits[below] = splits.get(below, 0) + 1
+        splits = dict( (p, count) for p, count in splits.iteritems() 
+                        if pieces[p] > 1 )
+        mines = dict( (p, count) for p, count in pieces.iteritems() 
+                        if count > 1 and p != owner )
+        return splits, mines
+        
+    def move_count(self, player):
+        """ how many moves legal_moves() would list if player was playing """
+        empty = len(self.empty)
+        moves = self.splits[player] * empty
+        hand = player.on_hand
+        if hand is not None:
+            own = self.own_top_sizes[hand.player]
+            for size in range(hand.size, len(self.top_sizes)):
+                moves += self.top_sizes[size] - own[size]
+            return moves + 2*empty
+        if PICK_EVERY_PIECE:
+            return moves + self.singles + self.placed
+        return moves + self.own_singles[player] + self.mines[player]
+        
+    def take_changes(self):
+        changed = self.changed
+        self.changed = set()
+        return changed
+           
+    def place(self, position, piece):
+        if not self.on_board(position):
+            raise GameError("Position is not on the board")
+        top = self.top(position)
+        if top is not None:
+            if top.player == piece.player:
+                raise GameError("Cannot place over your pieces")
+            if top.size < piece.size:
+                raise GameError("Cannot place over smaller pieces")
+        
+        self._push(position, piece)
+        self.touched(position, self.piece_key(position, piece))
+        if self.undo_stack is not None:
+            self.undo_stack.append( ("place", position, piece) )
+                    
+    def pick(self, where, piece):
+        if not where in self:
+            raise GameError("Cannot pick from nowhere")
+        
+        key = None
+        if self.top(where) is piece:
+            key = self.piece_key(where, piece)
+            index = self.height(where) - 1
+        elif self.undo_stack is not None:
+            index = self[where].index(piece)
+        self._remove(where, piece)
+        self.touched(where, key)
+        if self.undo_stack is not None:
+            self.undo_stack.append( ("pick", where, index, piece) )
+        
+        return piece
+            
+    def split(self, where_from, piece, where_to):
+        if not self.on_board(where_to):
+            raise GameError("Position is not on the board")
+        self._split(where_from, piece, where_to)
+        self.touched(where_from)
+        self.touched(where_to)
+        if self.undo_stack is not None:
+            self.undo_stack.append( ("split", where_from, where_to) )
+            
+    def start_undo(self):
+        """ 
+        place, pick and split keep what undo() needs from now on. Returns 
+        a mark for undo_to()
+        """
+        if self.undo_stack is None:
+            self.undo_stack = []
+        return len(self.undo_stack)
+        
+    def stop_undo(self):
+        self.undo_stack = None
+        
+    def undo(self):
+        """ takes back the last place, pick or split """
+        move = self.undo_stack.pop()
+        if move[0] == "place":
+            name, position, piece = move
+            key = self.piece_key(position, piece)
+            self._remove(position, piece)
+            self.touched(position, key)
+        elif move[0] == "pick":
+            name, where, index, piece = move
+            self._insert(where, index, piece)
+            key = None
+            if index == self.height(where) - 1:
+                key = self.piece_key(where, piece)
+            self.touched(where, key)
+        else:
+            name, where_from, where_to = move
+            self._join(where_from, where_to)
+            self.touched(where_from)
+            self.touched(where_to)
+            
+    def undo_to(self, mark):
+        while len(self.undo_stack) > mark:
+            self.undo()
+            
+    def make(self, player, move):
+        """ 
+        a move from legal_moves() straight on the board, without the checks
+        and updates Player does, for searches together with start_undo()
+        """
+        name, where = move[:2]
+        if name == "pick":
+            player.on_hand = self.pick(where, self.top(where))
+        elif name == "mine":
+            player.on_hand = self.pick(where, move[2])
+        elif name == "split":
+            self.split(where, move[2], move[3])
+        else:
+            self.place(where, player.on_hand)
+            player.on_hand = None
+        
+    def legal_moves(self, player):
+        """
+        every move player can make right now, each one a tuple with the 
+        name of the Player method and its arguments:
+            ("pick", where)  ("cap", where)  ("drop", where)
+            ("split", where_from, piece, where_to)  ("mine", where, piece)
+        """
+        if player.status != player.STATUS_PLAYING:
+            return []
+            
+        moves = []
+        hand = player.on_hand
+        empty = list(self.empty)
+        
+        if hand is not None:
+            for where, (owner, size, height) in self.tops.iteritems():
+                if owner != hand.player and size >= hand.size:
+                    moves.append( ("cap", where) )
+            for where in empty:
+                moves.append( ("cap", where) )
+                moves.append( ("drop", where) )
+        else:
+            for where, (owner, size, height) in self.tops.iteritems():
+                if height == 1 and (PICK_EVERY_PIECE or owner == player):
+                    moves.append( ("pick", where) )
+                    
+        for where, (owner, size, height) in self.tops.iteritems():
+            if height == 1 and not (hand is None and PICK_EVERY_PIECE):
+                continue
+            stack = self[where]
+            mine = [ p for p in stack if p.player == player ]
+            if hand is None:
+                if PICK_EVERY_PIECE:
+                    moves.extend( ("mine", where, p) for p in stack )
+                elif owner != player and len(mine) > 1:
+                    moves.extend( ("mine", where, p) for p in mine )
+            if len(mine) > 1:
+                for pos in range(1, height):
+                    if stack[pos-1].player == player:
+                        moves.extend( ("split", where, stack[pos], where_to)
+                                        for where_to in empty )
+        return moves
    
         
             
        
+def scatter(players, rnd=random):
+    """ 
+    layout for a new game, five pieces of each size per player each on a 
+    cell of its own, in time linear in the number of pieces
+    """
+    toset = [ (player, size) 
+                for player in players
+                for size in (1,2,3)
+                for amount in range(5)
+                ]
+    rnd.shuffle(toset)
+    pieces = len(toset)
+    side = int(math.ceil(math.sqrt(pieces*1.3)))
+    
+    cells = rnd.sample(xrange(side*side), pieces)
+    stacks = [ (divmod(cell, side), [id]) for id, cell in enumerate(cells) ]
+    return side, toset, stacks
+    
+def splitmix(x):
+    x = (x + 0x9E3779B97F4A7C15) & MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return x ^ (x >> 31)
+    
+def zobrist_key(id, x, y, depth):
+    """ the random number for a piece at a place in a stack, no table needed """
+    return splitmix((((id << 16 | x) << 16) | y) << 16 | depth)
+    
+def stack_hash(position, stack):
+    x, y = position
+    result = 0
+    for depth, piece in enumerate(stack):
+        result ^= zobrist_key(piece.id, x, y, depth)
+    return result
+    
+def board_hash(board_map):
+    """ Board.zobrist for a map like Game.get_board_map() gives """
+    result = 0
+    for (x, y), ids in board_map.iteritems():
+        for depth, id in enumerate(ids):
+            result ^= zobrist_key(id, x, y, depth)
+    return result
+    
+def player_code(index):
+    """ a, b ... z, aa, ab ... az, ba ... so there is one for every player """
+    code = ""
+    index += 1
+    while index:
+        index, rest = divmod(index - 1, len(string.lowercase))
+        code = string.lowercase[rest] + code
+    return code
+    
 class Server:
-    def __init__(self):
-        self._games = []
+    """
+    games are kept by id, which go up as they are created, and indexed by
+    status. Callables in .on_kill are called with every game killed and
+    the ones in .on_broadcast with (message, receivers) for every message
+    a game sends to all its players, listeners or spectators
+    """
+    def __init__(self, board_factory=Board):
+        self._games = {}
+        self._by_status = {}
+        self.next_id = 0
+        self.board_factory = board_factory
+        self.on_kill = []
+        self.on_broadcast = []
         
     def games(self):
-        return self._games
+        return [ self._games[id] for id in sorted(self._games) ]
+        
+    def game(self, id):
+        if not id in self._games:
+            raise GameError("No such game")
+        return self._games[id]
         
-    def create_game(self, name):
-        game = Game(name, self)
-        self._games.append(game)
+    def create_game(self, name, seed=None):
+        game = Game(name, self, seed)
+        game.id = self.next_id
+        self.next_id += 1
+        self._games[game.id] = game
+        self._by_status.setdefault(game.status, set()).add(game.id)
         return game
             
     def kill(self, game):
-        if game in self._games:
-            self._games.remove(game)
+        if self._games.get(game.id) is game:
+            del self._games[game.id]
+            self._by_status[game.status].discard(game.id)
+            for callback in self.on_kill:
+                callback(game)
+                
+    def broadcast(self, name, receivers):
+        for callback in self.on_broadcast:
+            callback(name, receivers)
+                
+    def sweep(self, now=None):
+        """
+        evicts players that disconnected or were idle for IDLE_PLAYER 
+        seconds and kills games finished or empty for IDLE_GAME seconds.
+        Returns how many players and games went
+        """
+        if now is None:
+            now = time.time()
+        evicted = killed = 0
+        for game in self.games():
+            for p in list(game.players):
+                if p.status in (p.STATUS_LEFT, p.STATUS_DONE):
+                    continue
+                idle = p.status in (p.STATUS_WAIT, p.STATUS_READY, 
+                                    p.STATUS_PLAYING) and \
+                        now - p.last_active > IDLE_PLAYER
+                if p.disconnected or idle:
+                    game.evict(p)
+                    evicted += 1
+            abandoned = game.status == game.STATUS_DONE or \
+                (game.status == game.STATUS_WAITING and not game.players)
+            if abandoned and now - game.last_active > IDLE_GAME and \
+                    game.id in self._games:
+                self.kill(game)
+                killed += 1
+        return evicted, killed
+                
+    def status_changed(self, game, old):
+        if self._games.get(game.id) is game:
+            self._by_status[old].discard(game.id)
+            self._by_status.setdefault(game.status, set()).add(game.id)
+            
+    def list_games(self, offset=0, limit=50, status=None):
+        """
+        (total, page) of the games, oldest first, where page has (id, name,
+        status, players) for up to limit games. status is a state name like
+        "STATUS_WAITING" to list only those games
+        """
+        if status is None:
+            ids = self._games.keys()
+        else:
+            ids = self._by_status.get(state_number(Game.states, status), ())
+        ids = sorted(ids)
+        page = []
+        for id in ids[offset:offset+limit]:
+            game = self._games[id]
+            page.append( (id, game.name, game.state_repr(), len(game.players)) )
+        return len(ids), page
+        
+def state_number(states, name):
+    """ the number make_states() gives to a state name """
+    names = [ s.strip() for s in states.split("\n") ]
+    if not name or not name in names:
+        raise GameError("Unknown state %r"%(name,))
+    return names.index(name)
         
 class StateMixin:
     def make_states(self):
@@ -152,6 +620,128 @@ class StateMixin:
     def __repr__(self):
         return "<%s: state == %s>"%(self.__class__.__name__, self.state_repr())
         
+class Outbox:
+    """
+    What is still to be sent to one remote. At most max_in_flight calls
+    wait for an answer, the rest waits here and newer state replaces older:
+    a set_board drops the patches before it, patches merge into one, and
+    any other message replaces the unsent one with the same name.
+    on_reply(name, result) gets the answers, on_lost(reason) the failures
+    """
+    def __init__(self, remote, on_reply=None, on_lost=None, 
+                 max_in_flight=MAX_IN_FLIGHT):
+        self.remote = remote
+        self.on_reply = on_reply
+        self.on_lost = on_lost
+        self.max_in_flight = max_in_flight
+        self.slow_after = SLOW_AFTER
+        self.in_flight = []
+        self.order = []
+        self.pending = {}
+        self.copied = False
+        self.sent = 0
+        self.superseded = 0
+        self.slow_count = 0
+        self.was_slow = False
+        self.longest_wait = 0.0
+        
+    def send(self, name, *args):
+        if name == "patch_board":
+            if "set_board" in self.pending:
+                return self.patch_pending_board(*args)
+            args = self.merge(*args)
+        elif name == "set_board":
+            self.drop("patch_board")
+            self.copied = False
+        self.drop(name)
+        self.pending[name] = args
+        self.order.append(name)
+        self.flush()
+        
+    def drop(self, name):
+        if name in self.pending:
+            del self.pending[name]
+            self.order.remove(name)
+            self.superseded += 1
+            
+    def patch_pending_board(self, seq, delta):
+        board, old_seq = self.pending["set_board"]
+        if not self.copied:
+            board = dict(board)
+            self.copied = True
+        for where, stack in delta.items():
+            if stack:
+                board[where] = stack
+            else:
+                board.pop(where, None)
+        self.pending["set_board"] = (board, seq)
+        self.superseded += 1
+        
+    def merge(self, seq, delta):
+        """ 
+        patch_board arguments, on top of the unsent patch if any. Merged 
+        patches say which seq they start from
+        """
+        if "patch_board" in self.pending:
+            old = self.pending["patch_board"]
+            merged = dict(old[1])
+            merged.update(delta)
+            base = old[0] - 1
+            if len(old) > 2:
+                base = old[2]
+            return (seq, merged, base)
+        return (seq, delta)
+        
+    def flush(self):
+        while self.order and len(self.in_flight) < self.max_in_flight:
+            name = self.order.pop(0)
+            args = self.pending.pop(name)
+            started = time.time()
+            self.in_flight.append(started)
+            self.sent += 1
+            d = defer.maybeDeferred(self.remote.callRemote, name, *args)
+            d.addCallbacks(self.replied, self.lost, 
+                           callbackArgs=(name, started), 
+                           errbackArgs=(started,))
+        if self.order and not self.was_slow and self.slow():
+            self.was_slow = True
+            self.slow_count += 1
+            if VERBOSE:
+                print "slow client:", self.remote
+                
+    def done(self, started):
+        self.in_flight.remove(started)
+        self.longest_wait = max(self.longest_wait, time.time() - started)
+        if not self.slow():
+            self.was_slow = False
+        
+    def replied(self, result, name, started):
+        self.done(started)
+        if self.on_reply is not None:
+            self.on_reply(name, result)
+        self.flush()
+        
+    def lost(self, reason, started):
+        self.done(started)
+        if self.on_lost is not None:
+            self.on_lost(reason)
+        self.flush()
+            
+    def waiting(self):
+        return len(self.order)
+        
+    def slow(self):
+        """ waiting on an answer for more than slow_after seconds """
+        return bool(self.in_flight) and \
+                time.time() - self.in_flight[0] > self.slow_after
+                
+    def stats(self):
+        return {"sent": self.sent, "superseded": self.superseded, 
+                "in_flight": len(self.in_flight), "waiting": self.waiting(),
+                "slow": self.slow(), "slow_count": self.slow_count,
+                "longest_wait": self.longest_wait}
+    
+
 class Game(StateMixin):
     states = """
         STATUS_WAITING
@@ -162,20 +752,44 @@ class Game(StateMixin):
     def __repr__(self):
         return "<%s:%s: state == %s>"%(self.__class__.__name__, self.name, self.state_repr())
             
-    def __init__(self, name, server):
+    def __init__(self, name, server, seed=None):
         self.make_states()
         self.server = server
+        self.seed = seed
+        self.id = None
         self.status = self.STATUS_WAITING
         self.name = name
         self.players = []
         self.board = None
         self.winner = None
-        self.pending_send = 0
+        self.cache = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.outboxes = {}
+        self.max_in_flight = MAX_IN_FLIGHT
+        self.seq = 0
+        self.batching = False
+        self.log = []
+        self.checkpoints = {}
+        self.checkpoint_every = CHECKPOINT_EVERY
+        self.last_active = time.time()
+        self.listeners = []
+        self.watchers = []
+        self.spectator_tick = SPECTATOR_TICK
+        self.watch_timer = None
+        
+    def set_status(self, status):
+        old = self.status
+        self.status = status
+        if old != status:
+            self.server.status_changed(self, old)
         
     def join(self, name):
         if self.status == self.STATUS_WAITING:
             player = Player(name, self)
             self.players.append( player )
+            self.notify("player_joined", name)
+            self.show()
             return player
         else:
             raise GameError("Cannot join ongoing game")        
@@ -185,18 +799,24 @@ class Game(StateMixin):
             return False
             
         ready = sum([ 1 for p in self.players if p.status == p.STATUS_READY ])
-        print "players ready:", ready, "of", len(self.players)
+        if VERBOSE:
+            print "players ready:", ready, "of", len(self.players)
         if ready != len(self.players):
             return False
                     
         for p in self.players:
             p.status = p.STATUS_PLAYING
-            self.status = self.STATUS_PLAYING
-            self.board = Board(self.players)
+        self.set_status(self.STATUS_PLAYING)
+        self.board = self.server.board_factory(self.players, seed=self.seed)
             
         for i,p in enumerate(self.players):
-            p.code = string.lowercase[i]
+            p.code = player_code(i)
+        self.cache.clear()
+        self.check_blocked()
+        self.checkpoint()
         self.send_all()
+        self.notify("game_started", self.board.side)
+        self.show()
         return True
         
     def check_done(self):
@@ -210,17 +830,43 @@ class Game(StateMixin):
                 if not p.status in (p.STATUS_BLOCKED, p.STATUS_PASS, p.STATUS_LEFT):
                     return False
                     
-        #todo: count scores
+        self.winner = self.leader()
 
         self.players = [ p for p in self.players 
                             if p.status != p.STATUS_LEFT ]
                 
         for p in self.players:
             p.status = p.STATUS_DONE
-        self.status = self.STATUS_DONE
+        self.set_status(self.STATUS_DONE)
+        winner = self.winner and self.winner.name
+        self.notify("game_finished", self.standings(), winner)
+        self.show()
         
         return True
         
+    def standings(self):
+        """ (name, towers, score) for every player, best score first """
+        if self.board is None:
+            return []
+        board = self.board
+        return sorted([ (p.name, board.towers[p], board.scores[p]) 
+                            for p in board.players ], 
+                      key=lambda s: (-s[2], -s[1]))
+                      
+    def leader(self):
+        """ the player with the best score and then most towers, if any """
+        if self.board is None:
+            return None
+        board = self.board
+        best = sorted(board.players, 
+                      key=lambda p: (board.scores[p], board.towers[p]))
+        if len(best) > 1:
+            first, second = best[-1], best[-2]
+            if (board.scores[first], board.towers[first]) == \
+                    (board.scores[second], board.towers[second]):
+                return None
+        return best[-1]
+        
     def left(self, player):
         if self.status == self.STATUS_WAITING:
             if player in self.players:
@@ -231,53 +877,250 @@ class Game(StateMixin):
                 if p.status != p.STATUS_LEFT:
                     allgone = False
             if allgone:
-                self.status = self.STATUS_DONE
+                self.set_status(self.STATUS_DONE)
                 self.server.kill(self)
+            elif self.status == self.STATUS_PLAYING:
+                self.check_done()
              
     def send_all(self):
         board_map = self.get_board_map()
         pieces_map = self.get_piece_map()
         
+        receivers = 0
         for p in self.players:
             if p.remote_board:
-                d = p.remote_board.callRemote("set_pieces", pieces_map)
-                d = p.remote_board.callRemote("set_board", board_map)
+                outbox = self.outbox(p)
+                outbox.send("set_pieces", pieces_map)
+                outbox.send("set_board", board_map, self.seq)
+                receivers += 1
+        self.server.broadcast("set_board", receivers)
+                
+    def send_to(self, player):
+        if player.remote_board and self.board is not None:
+            self.outbox(player).send("set_pieces", self.get_piece_map())
+            self.resync(player)
+        
+    def resync(self, player):
+        if player.remote_board and self.board is not None:
+            self.outbox(player).send("set_board", 
+                                     self.get_board_map(), self.seq)
        
-    def moved(self):
-        board_map = self.get_board_map()
+    def apply_moves(self, player, moves):
+        """
+        makes all the moves or none of them. moves are tuples like the ones
+        from Board.legal_moves, players get a single update at the end
+        """
+        if self.board is None:
+            raise GameError("Game has not started")
+            
+        board = self.board
+        recording = board.undo_stack is not None
+        mark = board.start_undo()
+        on_hand = player.on_hand
+        logged = len(self.log)
+        self.batching = True
+        try:
+            for move in moves:
+                if not move[0] in MOVES:
+                    raise GameError("Unknown move %r"%(move[0],))
+                getattr(player, move[0])(*move[1:])
+        except:
+            board.undo_to(mark)
+            board.take_changes()
+            player.on_hand = on_hand
+            if self.log is not None:
+                for index in range(logged+1, len(self.log)+1):
+                    self.checkpoints.pop(index, None)
+                del self.log[logged:]
+            raise
+        finally:
+            self.batching = False
+            if not recording:
+                board.stop_undo()
+        self.moved()
+        
+    def record(self, player, name, *args):
+        """ 
+        appends an accepted move to the log, pieces go in by id. 
+        Every checkpoint_every moves the whole game is saved too
+        """
+        player.active()
+        if self.log is None or self.board is None:
+            return
+        args = tuple( a.id if isinstance(a, Piece) else a for a in args )
+        self.log.append( (player.code, name, args) )
+        if len(self.log) % self.checkpoint_every == 0:
+            self.checkpoint()
+            
+    def checkpoint(self):
+        if self.log is not None:
+            self.checkpoints[len(self.log)] = snapshot.encode(self)
+        
+    def check_blocked(self):
+        """ 
+        players without moves go BLOCKED and back to PLAYING once they have 
+        some again, the game ends when nobody can move
+        """
+        blocked = False
+        for p in self.players:
+            if p.status == p.STATUS_PLAYING:
+                if not self.board.move_count(p):
+                    p.status = p.STATUS_BLOCKED
+                    blocked = True
+            elif p.status == p.STATUS_BLOCKED:
+                if self.board.move_count(p):
+                    p.status = p.STATUS_PLAYING
+        if blocked:
+            self.check_done()
         
-        all = [ (p.on_hand, p.name) for p in self.players ]
+    def moved(self):
+        if self.batching:
+            return
+        changes = self.board.take_changes()
+        if not changes:
+            return
+        self.seq += 1
+        self.check_blocked()
+        self.show()
+        if not [ p for p in self.players if p.remote_board ]:
+            return
+        delta = self.get_board_delta(changes)
         
+        receivers = 0
         for p in self.players:
             if p.remote_board:
-                self.pending_send += 1
-                print "Queue for", p.name
-                d = p.remote_board.callRemote("set_board", board_map)
-                d.addCallback(self.sent)
-                continue
-                hand = p.on_hand
-                d = p.remote_board.callRemote("set_on_hand", hand, all)        
-                d.addCallback(self.sent)
-                d.addErrback(self.errback)
+                if VERBOSE:
+                    print "Queue for", p.name
+                self.outbox(p).send("patch_board", self.seq, delta)
+                receivers += 1
+        self.server.broadcast("patch_board", receivers)
+            
+    def evict(self, player):
+        """ player leaves for good, the game goes on without it """
+        self.outboxes.pop(player.remote_board, None)
+        player.remote_board = None
+        player.leave()
+        if self.status == self.STATUS_WAITING and self.players:
+            self.check_ready()
+            
+    def outbox(self, player):
+        """ the Outbox for the player's remote board """
+        remote = player.remote_board
+        if not remote in self.outboxes:
+            def replied(name, want_resync):
+                if name == "patch_board" and want_resync:
+                    self.resync(player)
+            self.outboxes[remote] = Outbox(remote, replied, self.errback,
+                                           self.max_in_flight)
+        return self.outboxes[remote]
+        
+    def slow_outboxes(self):
+        return [ o for o in self.outboxes.values() if o.slow() ]
+        
+    def subscribe(self, remote):
+        """ 
+        remote gets player_joined(name), player_ready(name), 
+        game_started(side) and game_finished(standings, winner)
+        """
+        if not remote in self.listeners:
+            self.listeners.append(remote)
             
+    def unsubscribe(self, remote):
+        if remote in self.listeners:
+            self.listeners.remove(remote)
+            
+    def notify(self, event, *args):
+        for remote in list(self.listeners):
+            d = defer.maybeDeferred(remote.callRemote, event, *args)
+            d.addErrback(lambda reason, remote=remote: self.unsubscribe(remote))
+        self.server.broadcast(event, len(self.listeners))
+        
+    def watch(self, remote):
+        """ 
+        remote gets set_snapshot(data) with the whole game now and then 
+        at most once every spectator_tick seconds while it changes
+        """
+        if not remote in self.watchers:
+            self.watchers.append(remote)
+        self.send_snapshot(snapshot.encode(self), [remote])
+        
+    def unwatch(self, remote):
+        if remote in self.watchers:
+            self.watchers.remove(remote)
+        self.outboxes.pop(remote, None)
+        
+    def show(self):
+        """ lets the spectators know something changed """
+        if not self.watchers or self.watch_timer is not None:
+            return
+        if self.spectator_tick:
+            from twisted.internet import reactor
+            self.watch_timer = reactor.callLater(self.spectator_tick, 
+                                                 self.show_now)
+        else:
+            self.show_now()
+            
+    def show_now(self):
+        """ one snapshot, the same string goes to every spectator """
+        self.watch_timer = None
+        if self.watchers:
+            self.send_snapshot(snapshot.encode(self), list(self.watchers))
+        
+    def send_snapshot(self, data, remotes):
+        for remote in remotes:
+            if not remote in self.outboxes:
+                self.outboxes[remote] = Outbox(remote, 
+                            on_lost=lambda reason, remote=remote: 
+                                        self.unwatch(remote),
+                            max_in_flight=self.max_in_flight)
+            self.outboxes[remote].send("set_snapshot", data)
+        self.server.broadcast("set_snapshot", len(remotes))
+        
     def errback(self, reason):
         print reason
         
-    def sent(self, *args):
-        self.pending_send -= 1
-        #print "sent!, pending =", self.pending_send
-                
-                
+    def cached(self, name, version, build):
+        """ 
+        build() once per version, the result is shared by everybody 
+        asking so it must not be changed
+        """
+        if name in self.cache and self.cache[name][0] == version:
+            self.cache_hits += 1
+            return self.cache[name][1]
+        self.cache_misses += 1
+        value = build()
+        self.cache[name] = (version, value)
+        return value
+        
     def get_board_map(self):
+        version = (self.board, self.board.version)
+        return self.cached("board_map", version, self.build_board_map)
+        
+    def build_board_map(self):
         result = {}
         for location, stack in self.board:
             result[location] = [ p.id for p in stack ]
             
         return result
         
+    def get_board_delta(self, positions):
+        """ 
+        stacks for the given positions, an empty stack means 
+        there is nothing there anymore
+        """
+        result = {}
+        for location in positions:
+            stack = self.board[location]
+            result[location] = [ p.id for p in stack or () ]
+        return result
+        
     def get_piece_map(self):
+        """ pieces do not change, only a new board makes a new map """
+        return self.cached("piece_map", self.board, self.build_piece_map)
+        
+    def build_piece_map(self):
         result = {}
-        for id, piece in self.board.piece_map.items():
+        for id, piece in enumerate(self.board.piece_map):
             result[id]=(piece.player.name, piece.size, piece.player.code)
         return result
         
@@ -304,10 +1147,23 @@ class Player(StateMixin):
         self.game = game
         self.on_hand = None
         self.remote_board = None
+        self.code = None
+        self.disconnected = False
+        self.bot = None
+        self.last_active = time.time()
+        
+    def active(self):
+        self.last_active = self.game.last_active = time.time()
+        
+    def disconnect(self):
+        """ the client went away, Server.sweep() evicts the player """
+        self.disconnected = True
     
     def set_ready(self):
         if self.status in (self.STATUS_READY, self.STATUS_WAIT):
             self.status = self.STATUS_READY
+            self.active()
+            self.game.notify("player_ready", self.name)
             self.game.check_ready()
         else:
             raise GameError("Cannot get ready")
@@ -315,6 +1171,7 @@ class Player(StateMixin):
     def set_wait(self):
         if self.status in (self.STATUS_READY, self.STATUS_WAIT):
             self.status = self.STATUS_WAIT
+            self.active()
         else:
             raise GameError("Cannot go waiting")
     
@@ -324,12 +1181,14 @@ class Player(StateMixin):
         if self.status in (self.STATUS_PLAYING, self.STATUS_BLOCKED, self.STATUS_PASS):
             self.status = self.STATUS_PASS
             self.game.check_done()
+            self.game.record(self, "pass_move")
         else:
             raise GameError("Cannot go waiting")
             
     def leave(self):
         self.status = self.STATUS_LEFT
         self.game.left(self)
+        self.game.record(self, "leave")
         
     def pick(self, where):
         if self.status != self.STATUS_PLAYING:
@@ -338,6 +1197,8 @@ class Player(StateMixin):
             raise GameError("Cannot hold two pieces")
             
         stack = self.game.board[where]
+        if stack is None:
+            raise GameError("Cannot pick from nowhere")
         if len(stack) != 1:
             raise GameError("Canot pick from stack with many pieces")
         if not PICK_EVERY_PIECE:
@@ -346,6 +1207,7 @@ class Player(StateMixin):
         piece = self.game.board.pick(where, stack[0])
         self.on_hand = piece    
         self.game.moved()
+        self.game.record(self, "pick", where)
         
     def cap(self, where):
         if self.status != self.STATUS_PLAYING:
@@ -356,6 +1218,7 @@ class Player(StateMixin):
         self.game.board.place(where, self.on_hand)
         self.on_hand = None
         self.game.moved()
+        self.game.record(self, "cap", where)
             
     def drop(self, where):
         if self.status != self.STATUS_PLAYING:
@@ -369,6 +1232,7 @@ class Player(StateMixin):
             self.game.board.place(where, self.on_hand)
             self.on_hand = None
             self.game.moved()
+            self.game.record(self, "drop", where)
             return True
         else:
             raise GameError("Cannot drop, there are pieces there already") 
@@ -378,7 +1242,7 @@ class Player(StateMixin):
         if self.status != self.STATUS_PLAYING:
             raise GameError("Cannot Move, wrong status")
             
-        stack = self.game.board[where_from]
+        stack = self.game.board[where_from] or []
         
         if len([ p for p in stack if p.player == self ]) < 2:
             raise GameError("Need two or more pieces to split")
@@ -398,6 +1262,7 @@ class Player(StateMixin):
         self.game.board.split(where_from, piece, where_to)
         
         self.game.moved()        
+        self.game.record(self, "split", where_from, piece, where_to)
         
     def mine(self, where, piece):
         if self.on_hand is not None:
@@ -408,7 +1273,7 @@ class Player(StateMixin):
             if piece.player != self:
                 raise GameError("Cannot mine another players pieces")
         
-        stack = self.game.board[where]
+        stack = self.game.board[where] or []
 
         if not piece in stack:
             raise GameError("Piece is not There")
@@ -423,13 +1288,14 @@ class Player(StateMixin):
         self.on_hand = piece
         self.game.board.pick(where, piece)
         self.game.moved()
+        self.game.record(self, "mine", where, piece)
         
     
 ### UTITLITY ##
 
-def game_for(num_players):
-    server = Server()
-    game = server.create_game("the game")      
+def game_for(num_players, board_factory=Board, seed=None):
+    server = Server(board_factory)
+    game = server.create_game("the game", seed)      
     players = []
     for i in range(num_players):
         p = game.join("player %i"%i)
@@ -439,6 +1305,27 @@ def game_for(num_players):
         p.set_ready()
     return game
     
+def play_randomly(game, moves, rnd=random):
+    """ makes up to that many random legal moves, each by a random player """
+    for i in range(moves):
+        playing = [ p for p in game.players if p.status == p.STATUS_PLAYING ]
+        if not playing:
+            break
+        player = rnd.choice(playing)
+        options = game.board.legal_moves(player)
+        if options:
+            move = rnd.choice(options)
+            getattr(player, move[0])(*move[1:])
+    return game
+    
+def first_move(player, kind, *args):
+    """ the first legal move of that kind, in board order, or None """
+    found = [ m for m in player.game.board.legal_moves(player) 
+                if m[0] == kind and m[1:len(args)+1] == args ]
+    if found:
+        return min(found)
+    return None
+    
 def random_moved(game):
     g = game
     g.board.dump()
@@ -446,21 +1333,15 @@ def random_moved(game):
     side = g.board.side
     positions = [ (x,y) for x in range(side) for y in range(side) ]
     for where in positions:
-        if where in g.board and len(g.board[where])==1:
-            p = g.board[where][0].player
+        if g.board.height(where) == 1:
+            p = g.board.top(where).player
             p.pick(where)
-            capped = False
-            for where_to in positions:
-                if where_to!=where:
-                    try:
-                        p.cap(where_to)
-                        capped = True
-                    except GameError, e:
-                        pass
-            if not capped:
-                p.drop(where)
+            caps = [ m for m in g.board.legal_moves(p) 
+                        if m[0] == "cap" and m[1] != where ]
+            if caps:
+                p.cap(min(caps)[1])
             else:
-                pass#break 
+                p.drop(where)
         
        
     print "cap all"
@@ -472,41 +1353,20 @@ def random_moved(game):
         if s and len(s) > 3:
             for piece in s:
                 pl = piece.player
-                mined = False
-                try:
+                if first_move(pl, "mine", where, piece) is not None:
                     pl.mine(where, piece)
-                    mined = True
-                except GameError:
-                    pass
-                if mined:
-                    for k in [ (x,y) 
-                            for x in range(g.board.side) 
-                            for y in range(g.board.side) ]:
-                        try:
-                            pl.drop(k)
-                            #break
-                        except GameError:
-                            pass
+                    pl.drop(first_move(pl, "drop")[1])
     g.board.dump()    
     #return g
     print "readytosplit"
     for where in positions:
         s = g.board[where]
-        splat = False
         if s and len(s) > 3:
             for piece in s:
                 pl = piece.player
-                for k in [ (x,y) 
-                        for x in range(g.board.side) 
-                        for y in range(g.board.side) ]:
-                    try:
-                        pl.split(where, piece, k)
-                        splat = True
-                        break
-                    except GameError, e:
-                        pass
-        #if splat: break
-        #break
+                move = first_move(pl, "split", where, piece)
+                if move is not None:
+                    pl.split(*move[1:])
                     
     print "split all"
     g.board.dump()
@@ -545,6 +1405,7 @@ class TestLoginOut(unittest.TestCase):
             p.pass_move()
         
         self.assertEqual(game.status, game.STATUS_DONE)
+        self.assertEqual(game.winner, game.leader())
         
         for p in players:
             p.leave()
@@ -553,6 +1414,504 @@ class TestLoginOut(unittest.TestCase):
         
     def testutil(self):
         game = game_for(5)
+        
+    def testlisting(self):
+        server = self.server
+        games = [ server.create_game("game %i"%i) for i in range(30) ]
+        for game in games[5:10]:
+            game.join("p1").set_ready()
+        games[7].players[0].pass_move()
+        server.kill(games[3])
+        
+        self.assertEqual(server.game(games[4].id), games[4])
+        self.assertRaises(GameError, server.game, games[3].id)
+        total, page = server.list_games(2, 3)
+        self.assertEqual(total, 29)
+        self.assertEqual(page, [ (2, "game 2", "STATUS_WAITING", 0),
+                                 (4, "game 4", "STATUS_WAITING", 0),
+                                 (5, "game 5", "STATUS_PLAYING", 1) ])
+        total, page = server.list_games(status="STATUS_PLAYING")
+        self.assertEqual([ id for id, name, status, count in page ], [5, 6, 8, 9])
+        self.assertEqual(server.list_games(status="STATUS_DONE")[0], 1)
+        self.assertRaises(GameError, server.list_games, status="nope")
+        
+    def testseed(self):
+        one = game_for(30, seed=7)
+        other = game_for(30, seed=7)
+        self.assertEqual(one.get_board_map(), other.get_board_map())
+        self.assertEqual(one.get_piece_map(), other.get_piece_map())
+        self.assertEqual(len(one.board.tops), 30*15)
+        codes = [ p.code for p in one.players ]
+        self.assertEqual(codes[:3] + codes[25:28], ["a", "b", "c", "z", "aa", "ab"])
+        self.assertEqual(player_code(26*27), "aaa")
+        
+class StubRemote:
+    """ records the calls a game makes to a player's remote board """
+    def __init__(self, reply=None, hold=False):
+        self.calls = []
+        self.reply = reply
+        self.hold = hold
+        self.waiting = []
+        
+    def callRemote(self, name, *args):
+        self.calls.append( (name,) + args )
+        if self.hold:
+            d = defer.Deferred()
+            self.waiting.append(d)
+            return d
+        return defer.succeed(self.reply)
+        
+    def answer(self):
+        self.waiting.pop(0).callback(self.reply)
+        
+class TestBroadcast(unittest.TestCase):
+    def testdelta(self):
+        game = game_for(2)
+        remote = StubRemote()
+        p = game.players[0]
+        p.remote_board = remote
+        game.send_to(p)
+        
+        where, stack = [ (w, s) for w, s in game.board if len(s) == 1 ][0]
+        piece = stack[0]
+        p.pick(where)
+        
+        name, seq, delta = remote.calls[-1]
+        self.assertEqual(name, "patch_board")
+        self.assertEqual(seq, 1)
+        self.assertEqual(delta, {where: []})
+        
+        p.drop(where)
+        self.assertEqual(remote.calls[-1], ("patch_board", 2, {where: [piece.id]}))
+        
+    def testresync(self):
+        game = game_for(2)
+        remote = StubRemote(True)
+        p = game.players[0]
+        p.remote_board = remote
+        
+        where = [ w for w, s in game.board if len(s) == 1 ][0]
+        p.pick(where)
+        self.assertEqual(remote.calls[-1], 
+                    ("set_board", game.get_board_map(), game.seq))
+
+        
+    def testbatch(self):
+        game = game_for(2)
+        remote = StubRemote()
+        p = game.players[0]
+        p.remote_board = remote
+        before = game.get_board_map()
+        
+        where = [ w for w, s in game.board if len(s) == 1 ][0]
+        empty = sorted(game.board.empty)
+        moves = [ ("pick", where), ("drop", empty[0]), ("pick", empty[0]) ]
+        self.assertRaises(GameError, game.apply_moves, p, 
+                            moves + [("pick", where)])
+        self.assertEqual(game.get_board_map(), before)
+        self.assertEqual(p.on_hand, None)
+        self.assertEqual(remote.calls, [])
+        
+        game.apply_moves(p, moves + [("drop", empty[1])])
+        self.assertEqual(len(remote.calls), 1)
+        name, seq, delta = remote.calls[0]
+        self.assertEqual(sorted(delta), sorted([where, empty[0], empty[1]]))
+        
+    def testwatch(self):
+        game = game_for(2)
+        game.spectator_tick = 0
+        remote = StubRemote()
+        game.watch(remote)
+        self.assertEqual(remote.calls, [("set_snapshot", snapshot.encode(game))])
+        
+        p = game.players[0]
+        where = [ w for w, s in game.board if len(s) == 1 ][0]
+        p.pick(where)
+        self.assertEqual(remote.calls[-1], ("set_snapshot", snapshot.encode(game)))
+        self.assertEqual(snapshot.decode(remote.calls[-1][1]).get_board_map(), 
+                         game.get_board_map())
+        
+        game.unwatch(remote)
+        p.drop(where)
+        self.assertEqual(len(remote.calls), 2)
+        
+    def testcoalesce(self):
+        game = game_for(2)
+        game.spectator_tick = 60
+        remotes = [ StubRemote(), StubRemote() ]
+        for remote in remotes:
+            game.watch(remote)
+        
+        p = game.players[0]
+        where = [ w for w, s in game.board if len(s) == 1 ][0]
+        p.pick(where)
+        p.drop(where)
+        self.assertEqual([ len(r.calls) for r in remotes ], [1, 1])
+        self.assertTrue(game.watch_timer.active())
+        
+        game.watch_timer.cancel()
+        game.show_now()
+        data = [ r.calls[-1][1] for r in remotes ]
+        self.assertTrue(data[0] is data[1])
+        self.assertEqual(data[0], snapshot.encode(game))
+        
+class TestOutbox(unittest.TestCase):
+    def testsupersede(self):
+        remote = StubRemote(hold=True)
+        outbox = Outbox(remote, max_in_flight=1)
+        outbox.send("set_pieces", {0: ("a", 1, "a")})
+        outbox.send("set_board", {(0, 0): [0]}, 1)
+        outbox.send("patch_board", 2, {(0, 0): []})
+        outbox.send("patch_board", 3, {(1, 1): [0]})
+        self.assertEqual(len(remote.calls), 1)
+        self.assertEqual(outbox.waiting(), 1)
+        
+        remote.answer()
+        self.assertEqual(remote.calls[-1], ("set_board", {(1, 1): [0]}, 3))
+        outbox.send("patch_board", 4, {(1, 1): []})
+        outbox.send("patch_board", 5, {(2, 2): [0]})
+        remote.answer()
+        self.assertEqual(remote.calls[-1], 
+                         ("patch_board", 5, {(1, 1): [], (2, 2): [0]}, 3))
+        remote.answer()
+        self.assertEqual(outbox.stats()["sent"], 3)
+        self.assertEqual(outbox.stats()["superseded"], 3)
+        self.assertEqual(outbox.stats()["in_flight"], 0)
+        
+    def testslow(self):
+        game = game_for(2)
+        game.max_in_flight = 1
+        slow, fast = StubRemote(hold=True), StubRemote()
+        game.players[0].remote_board = slow
+        game.players[1].remote_board = fast
+        p = game.players[0]
+        for i in range(5):
+            where = [ w for w, s in game.board if len(s) == 1 ][0]
+            p.pick(where)
+            p.drop(where)
+        self.assertEqual(len(fast.calls), 10)
+        self.assertEqual(len(slow.calls), 1)
+        outbox = game.outbox(p)
+        self.assertEqual(outbox.waiting(), 1)
+        self.assertFalse(game.slow_outboxes())
+        outbox.slow_after = -1
+        self.assertEqual(game.slow_outboxes(), [outbox])
+        
+        slow.answer()
+        self.assertEqual(slow.calls[-1][:2], ("patch_board", 10))
+        self.assertEqual(slow.calls[-1][3], 1)
+
+    def testgone(self):
+        game = game_for(2)
+        class Gone(StubRemote):
+            def callRemote(self, name, *args):
+                raise pb.DeadReferenceError("Calling Stale Broker")
+        game.players[1].remote_board = Gone()
+        lost = []
+        game.errback = lost.append
+        where = [ w for w, s in game.board if len(s) == 1 ][0]
+        game.players[0].pick(where)
+        self.assertEqual(len(lost), 1)
+        self.assertEqual(game.outbox(game.players[1]).stats()["in_flight"], 0)
+        
+    def testfailed(self):
+        remote = StubRemote(hold=True)
+        lost = []
+        outbox = Outbox(remote, on_lost=lost.append, max_in_flight=1)
+        outbox.send("set_pieces", {})
+        outbox.send("set_board", {}, 1)
+        remote.waiting.pop(0).errback(pb.Error("Failed"))
+        self.assertEqual(len(lost), 1)
+        self.assertEqual(remote.calls[-1], ("set_board", {}, 1))
+        self.assertEqual(outbox.waiting(), 0)
+
+class TestUndo(unittest.TestCase):
+    board_factory = Board
+    
+    def state(self, game):
+        board = game.board
+        return (game.build_board_map(), dict(board.tops), set(board.empty),
+                dict(board.towers), dict(board.scores), board.placed, 
+                board.singles, dict(board.own_singles), list(board.top_sizes),
+                dict( (p, list(s)) for p, s in board.own_top_sizes.items() ),
+                dict(board.splits), dict(board.mines), 
+                dict( (p, board.move_count(p)) for p in game.players ),
+                board.zobrist, [ p.on_hand for p in game.players ])
+    
+    def testroundtrip(self):
+        rnd = random.Random(0)
+        for i in range(20):
+            game = game_for(rnd.randint(2, 5), self.board_factory, seed=i)
+            game.log = None
+            play_randomly(game, rnd.randint(0, 200), rnd)
+            board = game.board
+            players = [ p for p in game.players if p.status == p.STATUS_PLAYING ]
+            if not players:
+                continue
+            before = self.state(game)
+            
+            mark = board.start_undo()
+            states = []
+            for j in range(rnd.randint(1, 50)):
+                player = rnd.choice(players)
+                moves = board.legal_moves(player)
+                if not moves:
+                    continue
+                states.append( (len(board.undo_stack), self.state(game)) )
+                board.make(player, rnd.choice(moves))
+                self.assertEqual(board.zobrist, 
+                                 board_hash(game.build_board_map()))
+            while states:
+                depth, state = states.pop()
+                board.undo_to(depth)
+                for p, hand in zip(game.players, state[-1]):
+                    p.on_hand = hand
+                self.assertEqual(self.state(game), state)
+            board.undo_to(mark)
+            self.assertEqual(self.state(game), before)
+            self.assertEqual(board.undo_stack, [])
+            
+    def testbatch(self):
+        game = game_for(2, self.board_factory)
+        p = game.players[0]
+        before = game.build_board_map()
+        where = [ w for w, s in game.board if len(s) == 1 ][0]
+        empty = min(game.board.empty)
+        self.assertRaises(GameError, game.apply_moves, p, 
+                          [("pick", where), ("drop", empty), ("pick", where)])
+        self.assertEqual(game.build_board_map(), before)
+        self.assertEqual(game.board.undo_stack, None)
+        
+class TestHash(unittest.TestCase):
+    def testhash(self):
+        rnd = random.Random(1)
+        game = game_for(3, seed=1)
+        other = game_for(3, seed=2)
+        self.assertNotEqual(game.board.zobrist, other.board.zobrist)
+        for i in range(10):
+            play_randomly(game, 20, rnd)
+            board = game.board
+            self.assertEqual(board.zobrist, board_hash(game.build_board_map()))
+            copied = snapshot.decode(snapshot.encode(game))
+            self.assertEqual(copied.board.position_hash(), board.position_hash())
+            
+        board = game.board
+        before = board.position_hash()
+        player = [ p for p in game.players if p.on_hand is None ][0]
+        where = [ w for w, s in board if len(s) == 1 ][0]
+        board.start_undo()
+        board.make(player, ("pick", where))
+        self.assertNotEqual(board.position_hash(), before)
+        board.make(player, ("drop", where))
+        self.assertEqual(board.position_hash(), before)
+        board.make(player, ("pick", where))
+        board.undo_to(0)
+        player.on_hand = None
+        self.assertEqual(board.position_hash(), before)
+        
+class TestSweep(unittest.TestCase):
+    def testsweep(self):
+        s = Server()
+        playing = s.create_game("playing")
+        one, two, three = [ playing.join(name) for name in ("1", "2", "3") ]
+        for p in (one, two, three):
+            p.set_ready()
+        waiting = s.create_game("waiting")
+        late, ready = waiting.join("late"), waiting.join("ready")
+        ready.set_ready()
+        empty = s.create_game("empty")
+        
+        now = time.time()
+        self.assertEqual(s.sweep(now), (0, 0))
+        
+        one.disconnect()
+        late.last_active -= IDLE_PLAYER + 1
+        self.assertEqual(s.sweep(now), (2, 0))
+        self.assertEqual(one.status, one.STATUS_LEFT)
+        self.assertEqual(waiting.players, [ready])
+        self.assertEqual(waiting.status, waiting.STATUS_PLAYING)
+        
+        self.assertEqual(s.sweep(now + IDLE_GAME + 1), (0, 1))
+        self.assertEqual(s.games(), [playing, waiting])
+        
+        two.pass_move()
+        three.pass_move()
+        self.assertEqual(playing.status, playing.STATUS_DONE)
+        self.assertEqual(s.sweep(now + IDLE_GAME + 1), (0, 1))
+        self.assertEqual(s.games(), [waiting])
+        
+    def testlastleaves(self):
+        s = Server()
+        game = s.create_game("passed")
+        one, two = game.join("1"), game.join("2")
+        for p in (one, two):
+            p.set_ready()
+        one.pass_move()
+        two.leave()
+        self.assertEqual(game.status, game.STATUS_DONE)
+        game.last_active -= IDLE_GAME + 1
+        self.assertEqual(s.sweep(), (0, 1))
+        self.assertEqual(s.games(), [])
+        
+class TestCache(unittest.TestCase):
+    def testversions(self):
+        game = game_for(2)
+        game.cache.clear()
+        game.cache_hits = game.cache_misses = 0
+        board_map, piece_map = game.get_board_map(), game.get_piece_map()
+        self.assertTrue(game.get_board_map() is board_map)
+        self.assertTrue(game.get_piece_map() is piece_map)
+        
+        p = game.players[0]
+        where = [ w for w, s in game.board if len(s) == 1 ][0]
+        self.assertRaises(GameError, game.apply_moves, p, 
+                          [("pick", where), ("pick", where)])
+        after = game.get_board_map()
+        self.assertFalse(after is board_map)
+        self.assertEqual(after, board_map)
+        p.pick(where)
+        self.assertEqual(game.get_board_map(), game.build_board_map())
+        self.assertTrue(game.get_piece_map() is piece_map)
+        self.assertEqual((game.cache_hits, game.cache_misses), (3, 4))
+        
+class TestEvents(unittest.TestCase):
+    def testlifecycle(self):
+        s = Server()
+        game = s.create_game("g")
+        remote = StubRemote()
+        game.subscribe(remote)
+        one, two = game.join("one"), game.join("two")
+        one.set_ready()
+        two.set_ready()
+        self.assertEqual(remote.calls, [("player_joined", "one"), 
+                    ("player_joined", "two"), ("player_ready", "one"),
+                    ("player_ready", "two"), ("game_started", game.board.side)])
+        
+        one.pass_move()
+        two.pass_move()
+        self.assertEqual(remote.calls[-1], 
+                    ("game_finished", game.standings(), None))
+        
+        game.unsubscribe(remote)
+        game.notify("player_joined", "three")
+        self.assertEqual(len(remote.calls), 6)
+        
+    def testgone(self):
+        game = Server().create_game("g")
+        class Gone(StubRemote):
+            def callRemote(self, name, *args):
+                raise pb.DeadReferenceError("Calling Stale Broker")
+        game.subscribe(Gone())
+        game.join("one")
+        self.assertEqual(game.listeners, [])
+        
+class TestScores(unittest.TestCase):
+    def testscores(self):
+        game = play_randomly(game_for(3), 200)
+        towers = dict( (p, 0) for p in game.players )
+        scores = dict( (p, 0) for p in game.players )
+        for where, stack in game.board:
+            towers[stack[-1].player] += 1
+            scores[stack[-1].player] += len(stack)
+        self.assertEqual(game.board.towers, towers)
+        self.assertEqual(game.board.scores, scores)
+        
+        standings = game.standings()
+        self.assertEqual(sorted(standings), 
+                sorted( (p.name, towers[p], scores[p]) for p in game.players ))
+        self.assertEqual(standings[0][2], max(scores.values()))
+        
+class TestBlocked(unittest.TestCase):
+    def testcounts(self):
+        game = game_for(3)
+        for i in range(30):
+            play_randomly(game, 10)
+            for p in game.players:
+                self.assertEqual(game.board.move_count(p), 
+                                 len(game.board.legal_moves(p)))
+                                 
+    def testblocked(self):
+        game = Server().create_game("blocked")
+        p0 = game.join("p0")
+        p1 = game.join("p1")
+        for p in (p0, p1):
+            p.status = p.STATUS_PLAYING
+        game.set_status(game.STATUS_PLAYING)
+        layout = (1, [(p0, 3), (p0, 1)], [((0,0), [0])])
+        game.board = Board(game.players, layout)
+        p0.on_hand = game.board.piece_map[1]
+        
+        game.check_blocked()
+        self.assertEqual(p0.status, p0.STATUS_BLOCKED)
+        self.assertEqual(p1.status, p1.STATUS_PLAYING)
+        
+        p1.pick((0,0))
+        self.assertEqual(p0.status, p0.STATUS_PLAYING)
+        p0.drop((0,0))
+        self.assertEqual(p1.status, p1.STATUS_BLOCKED)
+        self.assertEqual(game.status, game.STATUS_PLAYING)
+        
+        p0.pass_move()
+        self.assertEqual(game.status, game.STATUS_DONE)
+        
+class TestLegalMoves(unittest.TestCase):
+    def accepted(self, game, player, move):
+        """ tries the move on a copy of the game """
+        copied = copy.deepcopy(game)
+        player = copied.players[game.players.index(player)]
+        args = [ copied.board.piece_map[a.id] if isinstance(a, Piece) else a
+                    for a in move[1:] ]
+        try:
+            getattr(player, move[0])(*args)
+            return True
+        except GameError:
+            return False
+            
+    def candidates(self, game):
+        board = game.board
+        cells = [ (x,y) for x in range(board.side) for y in range(board.side) ]
+        moves = []
+        for where in cells:
+            moves.extend( [("pick", where), ("cap", where), ("drop", where)] )
+        for where, stack in board:
+            for piece in stack:
+                moves.append( ("mine", where, piece) )
+                for where_to in cells[::4]:
+                    moves.append( ("split", where, piece, where_to) )
+        return moves
+        
+    def check(self, game):
+        candidates = self.candidates(game)
+        for player in game.players:
+            legal = set(game.board.legal_moves(player))
+            accepted = set( m for m in candidates 
+                                if self.accepted(game, player, m) )
+            self.assertEqual(legal.intersection(candidates), accepted)
+            
+    def testmoves(self):
+        game = random_moved(game_for(2))
+        self.check(game)
+        
+        player = game.players[0]
+        where, stack = min( (len(s), w, s) for w, s in game.board )[1:]
+        player.mine(where, stack[-1])
+        self.check(game)
+        
+        game.players[1].pass_move()
+        self.assertEqual(game.board.legal_moves(game.players[1]), [])
+        
+    def testoffboard(self):
+        game = game_for(2)
+        player = game.players[0]
+        where = [ w for w, s in game.board if len(s) == 1 ][0]
+        player.pick(where)
+        seq = game.seq
+        for position in [ (40000, 0), (-1, 0), (0, game.board.side) ]:
+            self.assertRaises(GameError, player.drop, position)
+            self.assertRaises(GameError, player.cap, position)
+        self.assertEqual(game.seq, seq)
+        self.assertTrue(player.on_hand is not None)
+        snapshot.encode(game)
 
 if __name__ == "__main__":
     unittest.main()
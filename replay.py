@@ -0,0 +1,159 @@
+"""
+Replaying logged games.
+
+Every model.Game logs the moves it accepts as (player code, method, args)
+and keeps a snapshot of itself every checkpoint_every moves, starting with
+the board it was dealt. replay() rebuilds the game as it was after any
+number of moves by decoding the nearest checkpoint and making the moves
+logged after it.
+
+save() and load() keep a game's log and checkpoints in a file, so a game
+can be taken off a server and replayed somewhere else. hashes() gives the
+Board.position_hash after every move, to find positions that repeat within
+a game or across saved games.
+
+Run this module to time replays of a long random game.
+"""
+import marshal
+import model
+import snapshot
+
+FORMAT = 1
+
+class ReplayError(ValueError): pass
+
+class GameLog:
+    def __init__(self, log, checkpoints):
+        self.log = log
+        self.checkpoints = checkpoints
+        
+def replay(source, index=None):
+    """ 
+    a new game as source was after its first index moves, source is a
+    model.Game or a GameLog 
+    """
+    log = source.log
+    if index is None:
+        index = len(log)
+    if not 0 <= index <= len(log):
+        raise ReplayError("Move %i is not in the log"%index)
+        
+    starts = [ i for i in source.checkpoints if i <= index ]
+    if not starts:
+        raise ReplayError("No checkpoint before move %i"%index)
+    start = max(starts)
+    
+    game = snapshot.decode(source.checkpoints[start])
+    game.log = None
+    players = dict( (p.code, p) for p in game.board.players )
+    for code, name, args in log[start:index]:
+        make(game, players[code], name, args)
+    return game
+    
+def hashes(source):
+    """ position hashes from the first checkpoint on, one per move """
+    start = min(source.checkpoints)
+    game = replay(source, start)
+    players = dict( (p.code, p) for p in game.board.players )
+    result = [ game.board.position_hash() ]
+    for code, name, args in source.log[start:]:
+        make(game, players[code], name, args)
+        result.append( game.board.position_hash() )
+    return result
+    
+def make(game, player, name, args):
+    if name in ("split", "mine"):
+        args = list(args)
+        args[1] = game.board.piece_map[args[1]]
+    getattr(player, name)(*args)
+    
+def save(game, path):
+    f = open(path, "wb")
+    try:
+        marshal.dump( (FORMAT, list(game.log), dict(game.checkpoints)), f )
+    finally:
+        f.close()
+        
+def load(path):
+    f = open(path, "rb")
+    try:
+        format, log, checkpoints = marshal.load(f)
+    finally:
+        f.close()
+    if format != FORMAT:
+        raise ReplayError("Unknown log format %i"%format)
+    return GameLog(log, checkpoints)
+    
+
+### BENCHMARK ###
+
+def bench(num_players=4, moves=10000, samples=100):
+    import time
+    
+    game = model.game_for(num_players)
+    while len(game.log) < moves:
+        model.play_randomly(game, moves - len(game.log))
+    print "game with", len(game.log), "moves and", len(game.checkpoints), "checkpoints"
+    
+    started = time.time()
+    for i in range(samples):
+        replay(game, (i * 7919) % len(game.log))
+    took = (time.time() - started) / samples
+    print "replay to a random move: %.2f ms"%(took*1000)
+    
+    started = time.time()
+    replay(game)
+    print "replay to the end: %.2f ms"%((time.time() - started)*1000)
+
+if __name__ == "__main__":
+    bench()
+    
+    
+### TESTS ###
+
+import os, tempfile
+import unittest
+
+class TestReplay(unittest.TestCase):
+    def testreplay(self):
+        game = model.game_for(3)
+        game.checkpoint_every = 20
+        snapshots = { 0: snapshot.encode(game) }
+        for i in range(70):
+            model.play_randomly(game, 1)
+            snapshots[len(game.log)] = snapshot.encode(game)
+        
+        self.assertEqual(sorted(game.checkpoints), [0, 20, 40, 60])
+        for index in (0, 1, 20, 33, 60, len(game.log)):
+            self.assertEqual(snapshot.encode(replay(game, index)), 
+                             snapshots[index])
+        self.assertRaises(ReplayError, replay, game, len(game.log) + 1)
+        
+        found = hashes(game)
+        self.assertEqual(len(found), len(game.log) + 1)
+        self.assertEqual(found[33], replay(game, 33).board.position_hash())
+        self.assertEqual(found[-1], game.board.position_hash())
+            
+    def testsave(self):
+        game = model.play_randomly(model.game_for(2), 30)
+        for p in game.players:
+            p.leave()
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            save(game, path)
+            replayed = replay(load(path))
+        finally:
+            os.remove(path)
+        self.assertEqual(snapshot.encode(replayed), snapshot.encode(game))
+        self.assertEqual(replayed.status, replayed.STATUS_DONE)
+        
+    def testevicted(self):
+        game = model.play_randomly(model.game_for(3), 10)
+        for p in game.players[:2]:
+            while p.on_hand is not None:
+                model.play_randomly(game, 1)
+            p.pass_move()
+        game.evict(game.players[2])
+        self.assertEqual(game.status, game.STATUS_DONE)
+        self.assertEqual(replay(game).status, game.STATUS_DONE)
@@ -1,20 +1,70 @@
 
 from twisted.spread import pb
-from twisted.internet import reactor
+from twisted.internet import reactor, task
 import model
+import bots
+import metrics
 
 class ServerError(pb.Error):   pass
 
+MAX_PAGE = 100
+MAX_SEATS = 8
+MAX_BOT_BUDGET = 2.0
+SWEEP_EVERY = 30.0
+
 class NetworkServer(pb.Root):
-    def __init__(self):
-        self.server = model.Server()
+    def __init__(self, board_factory=model.Board):
+        self.server = model.Server(board_factory)
+        self.network_games = {}
+        self.server.on_kill.append(self.killed)
+        self.server.on_broadcast.append(metrics.current.broadcast)
+        self.sweeper = task.LoopingCall(self.server.sweep)
+        
+    def start_sweeping(self, interval=SWEEP_EVERY):
+        """ evicts idle players and kills abandoned games now and then """
+        self.sweeper.start(interval, now=False)
+        
+    def start_dumping(self, path, interval=metrics.DUMP_EVERY):
+        """ writes stats() to path as JSON now and then """
+        self.dumper = metrics.start_dumping(path, self.stats, interval)
+        
+    def wrap(self, game):
+        """ the same NetworkGame for a game every time """
+        if not game.id in self.network_games:
+            self.network_games[game.id] = NetworkGame(game)
+        return self.network_games[game.id]
+        
+    def killed(self, game):
+        self.network_games.pop(game.id, None)
         
     def remote_games(self):
-        return [ (NetworkGame(g), g.name) for g in self.server.games() ]
+        return [ (self.wrap(g), g.name) for g in self.server.games() ]
+        
+    def remote_list_games(self, offset=0, limit=MAX_PAGE, status=None):
+        """ (total, [(id, name, status, players) ...]) one page at a time """
+        return self.server.list_games(offset, min(limit, MAX_PAGE), status)
+        
+    def remote_get_game(self, id):
+        return self.wrap(self.server.game(id))
 
     def remote_create_game(self, name):
         g = self.server.create_game(name)
-        return NetworkGame(g)
+        return self.wrap(g)
+        
+    def remote_stats(self):
+        return self.stats()
+        
+    def stats(self):
+        """ metrics.current.stats() and how many games, players and slow clients """
+        stats = metrics.current.stats()
+        games = self.server.games()
+        stats["games"] = {}
+        for g in games:
+            status = g.state_repr()
+            stats["games"][status] = stats["games"].get(status, 0) + 1
+        stats["players"] = sum([ len(g.players) for g in games ])
+        stats["slow_clients"] = sum([ len(g.slow_outboxes()) for g in games ])
+        return stats
         
     
 class NetworkGame(pb.Referenceable):
@@ -34,25 +84,76 @@ class NetworkGame(pb.Referenceable):
         
     def remote_name(self):
         return self.game.name
+        
+    def remote_id(self):
+        """ what get_game takes to find this game again """
+        return self.game.id
     
     def remote_get_side(self):
         return self.game.board.side
         
+    def remote_get_board(self):
+        """ (seq, board map, piece map) like set_board and set_pieces send """
+        if self.game.board is None:
+            raise ServerError("Game has not started")
+        return self.game.seq, self.game.get_board_map(), self.game.get_piece_map()
+        
+    def remote_get_hash(self):
+        """ (seq, hash of the stacks), compare with RemoteBoard.hash() """
+        if self.game.board is None:
+            raise ServerError("Game has not started")
+        return self.game.seq, self.game.board.zobrist
+        
+    def remote_standings(self):
+        """ (name, towers, score) for every player, best first """
+        winner = self.game.winner
+        if winner is not None:
+            winner = winner.name
+        return self.game.standings(), winner
+        
+    def remote_subscribe(self, listener):
+        """ 
+        listener gets the game events, see model.Game.subscribe. 
+        Returns what remote_player_status does
+        """
+        self.game.subscribe(listener)
+        notify(listener, self.game.unsubscribe)
+        return self.remote_player_status()
+        
+    def remote_unsubscribe(self, listener):
+        self.game.unsubscribe(listener)
+        
+    def remote_watch(self, board):
+        """ board gets set_snapshot(data) as the game goes, see snapshot.py """
+        self.game.watch(board)
+        notify(board, self.game.unwatch)
+        
+    def remote_unwatch(self, board):
+        self.game.unwatch(board)
+        
     def __repr__(self):
-        return "< g:"+self.name+">"
+        return "< g:"+self.game.name+">"
         
     def remote_sample_game(self, num_players):
-        players = []
-        for i in range(num_players-1):
-            p = self.game.join("player %i"%i)
-            players.append( p )
-            
         player = self.game.join("user")
-        for p in players:
-            p.set_ready()
-
+        self.remote_add_bots(num_players-1)
         return NetworkPlayer(player)
         
+    def remote_add_bots(self, count, budget=bots.BUDGET):
+        """ 
+        bots take count more seats, ready to play, up to MAX_SEATS players
+        and thinking MAX_BOT_BUDGET seconds at most 
+        """
+        if not isinstance(count, (int, long)) or \
+                not isinstance(budget, (int, long, float)):
+            raise ServerError("Bad bots")
+        count = min(count, MAX_SEATS - len(self.game.players))
+        budget = max(0, min(budget, MAX_BOT_BUDGET))
+        for i in range(count):
+            p = self.game.join("bot %i"%len(self.game.players))
+            bots.Bot(p, budget).start()
+            p.set_ready()
+        
     def remote_shuffle(self):
         if not self.game.status == self.game.STATUS_PLAYING:
             raise ServerError("Cannot Shuffle")
@@ -64,6 +165,8 @@ class NetworkPlayer(pb.Referenceable):
         
     def remote_set_board(self, board):
         self.player.remote_board = board
+        notify(board, lambda board: self.player.disconnect())
+        self.player.game.send_to(self.player)
         
     def remote_on_hand(self):
         if self.player.on_hand is None: return None
@@ -81,26 +184,101 @@ class NetworkPlayer(pb.Referenceable):
     def remote_leave(self):
         return self.player.leave()
         
+    def remote_disconnect(self):
+        """ for a shard front whose client went away """
+        self.player.disconnect()
+        
     def remote_pick(self, stack):
-        return self.player.pick(stack)
+        self.player.pick(self.position(stack))
+        return self.player.game.seq
         
     def remote_cap(self, stack):
-        return self.player.cap(stack)
+        self.player.cap(self.position(stack))
+        return self.player.game.seq
             
     def remote_drop(self, where):
-        return self.player.drop(where)
+        self.player.drop(self.position(where))
+        return self.player.game.seq
         
     def remote_split(self, stack, piece, where):
-        piece = self.player.game.board.piece_map[piece]
-        return self.player.split(stack, piece, where)
+        piece = self.piece(piece)
+        self.player.split(self.position(stack), piece, self.position(where))
+        return self.player.game.seq
         
     def remote_mine(self, stack, piece):
-        piece = self.player.game.board.piece_map[piece]
-        return self.player.mine(stack, piece)
+        piece = self.piece(piece)
+        self.player.mine(self.position(stack), piece)
+        return self.player.game.seq
+        
+    def remote_legal_moves(self):
+        """ Board.legal_moves for this player, with piece ids """
+        board = self.player.game.board
+        if board is None:
+            return []
+        return [ bots.move_ids(m) for m in board.legal_moves(self.player) ]
+        
+    def remote_apply_moves(self, moves):
+        """ 
+        moves like [("pick", stack), ("cap", where)], split and mine take 
+        piece ids as they do on their own. Either every move is made or none.
+        Moves answer the game's seq once they are made
+        """
+        batch = []
+        for move in moves:
+            name, args = move[0], [ self.position(a) for a in move[1:] ]
+            if name in ("split", "mine") and len(args) > 1:
+                args[1] = self.piece(args[1])
+            batch.append( tuple([name] + args) )
+        self.player.game.apply_moves(self.player, batch)
+        return self.player.game.seq
+        
+    def piece(self, id):
+        board = self.player.game.board
+        if board is None or not 0 <= id < len(board.piece_map):
+            raise model.GameError("No such piece")
+        return board.piece_map[id]
+        
+    def position(self, arg):
+        """ (x, y) for a position that came as a JSON list """
+        if isinstance(arg, list):
+            return tuple(arg)
+        return arg
         
 
+def notify(remote, callback):
+    """ callback(remote) once its client disconnects """
+    if hasattr(remote, "notifyOnDisconnect"):
+        remote.notifyOnDisconnect(callback)
+        
+metrics.instrument(NetworkServer, NetworkGame, NetworkPlayer)
+        
 if __name__ == '__main__':
-    reactor.listenTCP(9091, pb.PBServerFactory(
-                            NetworkServer()
-                        ))
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("--port", type="int", default=9091)
+    parser.add_option("--compact", action="store_true", default=False)
+    parser.add_option("--bot-processes", type="int", default=0)
+    parser.add_option("--wire-port", type="int", default=None,
+                      help="also serve the wire.py protocol on this port")
+    parser.add_option("--stats-file", default=None,
+                      help="dump the server's stats here as JSON")
+    parser.add_option("--stats-every", type="float", 
+                      default=metrics.DUMP_EVERY, help="seconds between dumps")
+    options, args = parser.parse_args()
+    if options.bot_processes:
+        bots.start_pool(options.bot_processes)
+    board_factory = model.Board
+    if options.compact:
+        import compact
+        board_factory = compact.CompactBoard
+    root = NetworkServer(board_factory)
+    root.start_sweeping()
+    if options.stats_file:
+        root.start_dumping(options.stats_file, options.stats_every)
+    reactor.listenTCP(options.port, 
+                      metrics.counting(pb.PBServerFactory(root)))
+    if options.wire_port:
+        import wire
+        reactor.listenTCP(options.wire_port, 
+                          metrics.counting(wire.WireServerFactory(root)))
     reactor.run()
@@ -0,0 +1,345 @@
+"""
+Sharded server.
+
+A front process owns the lobby and spreads the games over worker
+processes, each one a plain server.py on its own port. Clients connect to
+the front as they would to server.py: games and players come back as
+proxies that forward every call to the worker that owns the game, and
+references the client sends (its RemoteBoard) are proxied the other way,
+so the client API does not change. Workers only see the front, so when a
+client that set_board goes away the front tells its player to disconnect.
+
+Game ids are global: game local_id on worker i is local_id * N + i.
+
+    python shard.py --workers 4 --port 9091 --base-port 9100
+"""
+import sys, os, weakref, subprocess
+from optparse import OptionParser
+from twisted.spread import pb
+from twisted.internet import reactor, defer
+import server
+
+CONNECT_TRIES = 50
+CONNECT_DELAY = 0.2
+
+class Proxy(pb.Referenceable):
+    """ forwards every remote call to a RemoteReference """
+    def __init__(self, remote):
+        self.remote = remote
+        # message: function the answers to it go through
+        self.answers = {}
+
+    def remoteMessageReceived(self, broker, message, args, kw):
+        args = broker.unserialize(args)
+        if message == "set_board" and args and \
+                isinstance(args[0], pb.RemoteReference):
+            args[0].notifyOnDisconnect(self.client_lost)
+        args = wrap(args)
+        kw = wrap(broker.unserialize(kw))
+        d = self.remote.callRemote(message, *args, **kw)
+        d.addCallback(wrap)
+        if message in self.answers:
+            d.addCallback(self.answers[message])
+        return broker.serialize(d, self.perspective)
+
+    def client_lost(self, board):
+        """ the player, or the worker, may be gone already """
+        d = defer.maybeDeferred(self.remote.callRemote, "disconnect")
+        d.addErrback(lambda failure: None)
+
+_proxies = weakref.WeakValueDictionary()
+
+def proxy(remote):
+    """ the same Proxy for a remote object while somebody holds it """
+    key = (id(remote.broker), remote.luid)
+    p = _proxies.get(key)
+    if p is None:
+        p = _proxies[key] = Proxy(remote)
+    return p
+
+def wrap(value):
+    """ replaces the RemoteReferences in a result or arguments by Proxies """
+    if isinstance(value, pb.RemoteReference):
+        return proxy(value)
+    if isinstance(value, (list, tuple)):
+        return type(value)([ wrap(v) for v in value ])
+    if isinstance(value, dict):
+        return dict([ (k, wrap(v)) for k, v in value.items() ])
+    return value
+
+class ShardServer(pb.Root):
+    def __init__(self, workers):
+        """ workers are the root objects of the worker servers """
+        self.workers = workers
+        self.next_worker = 0
+
+    def locate(self, id):
+        """ (worker, local id) for a global game id """
+        if not isinstance(id, (int, long)) or id < 0:
+            raise server.ServerError("No such game")
+        return self.workers[id % len(self.workers)], id // len(self.workers)
+
+    def game(self, remote, index):
+        """ the Proxy for a game on worker index, answering global ids """
+        p = proxy(remote)
+        n = len(self.workers)
+        p.answers["id"] = lambda id: id * n + index
+        return p
+
+    def remote_games(self):
+        d = defer.gatherResults([ w.callRemote("games") for w in self.workers ])
+        d.addCallback(lambda results: [ (self.game(remote, index), name)
+                                        for index, games in enumerate(results)
+                                        for remote, name in games ])
+        return d
+
+    def remote_list_games(self, offset=0, limit=server.MAX_PAGE, status=None):
+        """
+        same as NetworkServer.remote_list_games, games ordered by worker
+        and then by age
+        """
+        limit = min(limit, server.MAX_PAGE)
+        d = defer.gatherResults([ w.callRemote("list_games", 0, 0, status)
+                                    for w in self.workers ])
+        d.addCallback(self.got_totals, offset, limit, status)
+        return d
+
+    def got_totals(self, totals, offset, limit, status):
+        totals = [ total for total, page in totals ]
+        pages = []
+        before = 0
+        for index, total in enumerate(totals):
+            start = max(offset - before, 0)
+            count = min(total - start, offset + limit - before - start)
+            if count > 0:
+                d = self.workers[index].callRemote("list_games",
+                                                   start, count, status)
+                d.addCallback(self.globalize, index)
+                pages.append(d)
+            before += total
+        d = defer.gatherResults(pages)
+        d.addCallback(lambda pages: (sum(totals), sum(pages, [])))
+        return d
+
+    def globalize(self, result, index):
+        total, page = result
+        n = len(self.workers)
+        return [ (id * n + index, name, status, players)
+                    for id, name, status, players in page ]
+
+    def remote_get_game(self, id):
+        worker, local = self.locate(id)
+        d = worker.callRemote("get_game", local)
+        return d.addCallback(self.game, id % len(self.workers))
+
+    def remote_create_game(self, name):
+        index = self.next_worker
+        self.next_worker = (self.next_worker + 1) % len(self.workers)
+        d = self.workers[index].callRemote("create_game", name)
+        return d.addCallback(self.game, index)
+
+def connect(host, port, tries=CONNECT_TRIES):
+    """ the root object of a server, waiting for it to start listening """
+    factory = pb.PBClientFactory()
+    reactor.connectTCP(host, port, factory)
+    d = factory.getRootObject()
+    def retry(failure):
+        if tries <= 1:
+            return failure
+        d = defer.Deferred()
+        reactor.callLater(CONNECT_DELAY, d.callback, None)
+        d.addCallback(lambda _: connect(host, port, tries - 1))
+        return d
+    d.addErrback(retry)
+    return d
+
+def spawn(ports, compact=False):
+    """ starts a server.py on each port, returns the processes """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "server.py")
+    processes = []
+    for port in ports:
+        args = [sys.executable, script, "--port", str(port)]
+        if compact:
+            args.append("--compact")
+        processes.append(subprocess.Popen(args))
+    return processes
+
+def start(port, addresses):
+    """ connects to the workers and then listens on port as the front """
+    d = defer.gatherResults([ connect(host, p) for host, p in addresses ])
+    def listen(workers):
+        return reactor.listenTCP(port, pb.PBServerFactory(ShardServer(workers)))
+    d.addCallback(listen)
+    return d
+
+def address(text):
+    host, port = text.rsplit(":", 1)
+    return host, int(port)
+
+### TESTS ###
+
+from twisted.trial import unittest
+from twisted.internet import task
+import model, client
+
+class CountingBoard(client.RemoteBoard):
+    patches = 0
+    
+    def remote_patch_board(self, seq, delta, base=None):
+        self.patches += 1
+        return client.RemoteBoard.remote_patch_board(self, seq, delta, base)
+
+class TestShard(unittest.TestCase):
+    """ two workers and the front on localhost, a client talking to the front """
+    
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.verbose = model.VERBOSE
+        model.VERBOSE = False
+        self.ports = []
+        self.workers = [ server.NetworkServer() for i in range(2) ]
+        addresses = []
+        for root in self.workers:
+            port = self.listen(root)
+            addresses.append( ("127.0.0.1", port.getHost().port) )
+        worker_roots = yield defer.gatherResults([ connect(host, p) 
+                                                    for host, p in addresses ])
+        self.connections = [ r.broker.transport for r in worker_roots ]
+        front = self.listen(ShardServer(worker_roots))
+        self.factory = pb.PBClientFactory()
+        reactor.connectTCP("127.0.0.1", front.getHost().port, self.factory)
+        self.root = yield self.factory.getRootObject()
+        
+    def listen(self, root):
+        port = reactor.listenTCP(0, pb.PBServerFactory(root), 
+                                 interface="127.0.0.1")
+        self.ports.append(port)
+        return port
+        
+    @defer.inlineCallbacks
+    def tearDown(self):
+        model.VERBOSE = self.verbose
+        self.factory.disconnect()
+        for transport in self.connections:
+            transport.loseConnection()
+        for port in self.ports:
+            yield port.stopListening()
+        yield task.deferLater(reactor, 0.05, lambda: None)
+        
+    @defer.inlineCallbacks
+    def until(self, condition, tries=100):
+        """ waits for condition() to be true """
+        for i in range(tries):
+            if condition():
+                return
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.fail("gave up waiting")
+        
+    @defer.inlineCallbacks
+    def testlist(self):
+        for i in range(5):
+            yield self.root.callRemote("create_game", "g%i" % i)
+        total, page = yield self.root.callRemote("list_games")
+        self.assertEqual(total, 5)
+        self.assertEqual([ (id, name) for id, name, status, players in page ],
+                [(0, "g0"), (2, "g2"), (4, "g4"), (1, "g1"), (3, "g3")])
+        
+        for offset, limit, ids in [(2, 2, [4, 1]), (4, 10, [3]), (1, 1, [2]),
+                                   (3, 2, [1, 3]), (5, 3, []), (0, 0, [])]:
+            total, page = yield self.root.callRemote("list_games", 
+                                                     offset, limit)
+            self.assertEqual(total, 5)
+            self.assertEqual([ p[0] for p in page ], ids)
+            
+        total, page = yield self.root.callRemote("list_games", 0, 10, 
+                                                 "STATUS_PLAYING")
+        self.assertEqual( (total, page), (0, []) )
+        
+    @defer.inlineCallbacks
+    def testids(self):
+        for i in range(5):
+            game = yield self.root.callRemote("create_game", "g%i" % i)
+            got = yield game.callRemote("id")
+            self.assertEqual(got, i)
+        games = yield self.root.callRemote("games")
+        for game, name in games:
+            got = yield game.callRemote("id")
+            self.assertEqual("g%i" % got, name)
+        for id in range(5):
+            game = yield self.root.callRemote("get_game", id)
+            name = yield game.callRemote("name")
+            self.assertEqual(name, "g%i" % id)
+            got = yield game.callRemote("id")
+            self.assertEqual(got, id)
+            self.assertEqual(self.workers[id % 2].server.game(id // 2).name, 
+                             "g%i" % id)
+        for id in (5, -1, "0"):
+            try:
+                yield self.root.callRemote("get_game", id)
+            except pb.RemoteError, e:
+                self.assertEqual(str(e), "No such game")
+            else:
+                self.fail("got game %r" % (id,))
+                
+    @defer.inlineCallbacks
+    def testmove(self):
+        game = yield self.root.callRemote("create_game", "g")
+        one = yield game.callRemote("join", "one")
+        two = yield game.callRemote("join", "two")
+        board = CountingBoard()
+        yield one.callRemote("set_board", board)
+        yield one.callRemote("set_ready")
+        yield two.callRemote("set_ready")
+        yield self.until(lambda: board.board is not None)
+        
+        moves = yield one.callRemote("legal_moves")
+        move = [ m for m in moves if m[0] == "pick" ][0]
+        seq = yield one.callRemote(*move)
+        yield self.until(lambda: board.seq == seq)
+        self.assertEqual(board.patches, 1)
+        self.assertFalse(move[1] in board.board)
+        
+        worker = self.workers[0].server.game(0)
+        self.assertEqual(board.board, worker.get_board_map())
+        self.assertEqual(board.hash(), worker.board.zobrist)
+        
+    @defer.inlineCallbacks
+    def testdisconnect(self):
+        game = yield self.root.callRemote("create_game", "g")
+        one = yield game.callRemote("join", "one")
+        yield one.callRemote("set_board", client.RemoteBoard())
+        player = self.workers[0].server.game(0).players[0]
+        self.assertFalse(player.disconnected)
+        self.factory.disconnect()
+        yield self.until(lambda: player.disconnected)
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("--port", type="int", default=9091)
+    parser.add_option("--workers", type="int", default=2)
+    parser.add_option("--base-port", type="int", default=9100)
+    parser.add_option("--worker", action="append", dest="addresses",
+                      help="host:port of a running server.py, "
+                           "instead of starting them")
+    parser.add_option("--compact", action="store_true", default=False)
+    options, args = parser.parse_args()
+
+    processes = []
+    if options.addresses:
+        addresses = [ address(a) for a in options.addresses ]
+    else:
+        ports = range(options.base_port, options.base_port + options.workers)
+        processes = spawn(ports, options.compact)
+        addresses = [ ("127.0.0.1", p) for p in ports ]
+
+    def stop_workers():
+        for p in processes:
+            if p.poll() is None:
+                p.terminate()
+    def failed(failure):
+        print "could not start:", failure.getErrorMessage()
+        reactor.stop()
+    reactor.addSystemEventTrigger("before", "shutdown", stop_workers)
+    start(options.port, addresses).addErrback(failed)
+    reactor.run()
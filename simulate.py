@@ -0,0 +1,162 @@
+"""
+Headless game simulations.
+
+Plays many seeded games without the network, spread over a process pool,
+and writes one JSON line per game as results come in. At the end it
+prints totals: game length, moves per second and how tall the stacks 
+ended up.
+
+A policy chooses a player's next move: it gets the player, the list from
+Board.legal_moves and a random.Random, and returns one of the moves or 
+None to pass. Policies are named in POLICIES or given as module:function,
+one per seat, repeating the last one for the remaining seats.
+
+    python simulate.py --games 1000 --players 4 --policy random --policy builder
+"""
+import time, random, json
+import multiprocessing
+from optparse import OptionParser
+import model
+
+PASS_CHANCE = 0.01
+
+def random_policy(player, moves, rnd):
+    """ any legal move, passing now and then """
+    if player.on_hand is None and rnd.random() < PASS_CHANCE:
+        return None
+    if moves:
+        return rnd.choice(moves)
+    return None
+    
+def builder_policy(player, moves, rnd):
+    """ caps the tallest towers it can with its own single pieces """
+    board = player.game.board
+    if player.on_hand is not None:
+        caps = [ m for m in moves if m[0] == "cap" and m[1] in board ]
+        if caps:
+            return max(caps, key=lambda m: board.height(m[1]))
+        return rnd.choice([ m for m in moves if m[0] == "drop" ])
+    picks = [ m for m in moves 
+                if m[0] == "pick" and board.top(m[1]).player == player ]
+    if picks:
+        return rnd.choice(picks)
+    return None
+    
+POLICIES = {
+    "random": random_policy,
+    "builder": builder_policy,
+}
+
+def find_policy(name):
+    if name in POLICIES:
+        return POLICIES[name]
+    module, function = name.split(":")
+    return getattr(__import__(module), function)
+    
+def play(seed, num_players, policies, max_moves):
+    """ plays one game to the end, or to max_moves, and describes it """
+    model.VERBOSE = False
+    rnd = random.Random(seed)
+    policies = [ find_policy(name) for name in policies ]
+    
+    started = time.time()
+    game = model.game_for(num_players, seed=seed)
+    seats = dict( (p, policies[min(i, len(policies)-1)]) 
+                    for i, p in enumerate(game.players) )
+    moves = 0
+    while game.status == game.STATUS_PLAYING and moves < max_moves:
+        playing = [ p for p in game.players if p.status == p.STATUS_PLAYING ]
+        player = rnd.choice(playing)
+        move = seats[player](player, game.board.legal_moves(player), rnd)
+        if move is None:
+            if player.on_hand is not None:
+                raise model.GameError("%s cannot pass holding a piece"%player.name)
+            player.pass_move()
+        else:
+            getattr(player, move[0])(*move[1:])
+            moves += 1
+    took = time.time() - started
+    
+    heights = {}
+    for where, stack in game.board:
+        heights[len(stack)] = heights.get(len(stack), 0) + 1
+    return {
+        "seed": seed,
+        "players": num_players,
+        "moves": moves,
+        "finished": game.status == game.STATUS_DONE,
+        "seconds": took,
+        "heights": heights,
+    }
+    
+def play_task(args):
+    return play(*args)
+    
+class Totals:
+    def __init__(self):
+        self.games = 0
+        self.finished = 0
+        self.moves = 0
+        self.seconds = 0.0
+        self.lengths = []
+        self.heights = {}
+        
+    def add(self, result):
+        self.games += 1
+        self.finished += result["finished"]
+        self.moves += result["moves"]
+        self.seconds += result["seconds"]
+        self.lengths.append(result["moves"])
+        for height, count in result["heights"].items():
+            height = int(height)
+            self.heights[height] = self.heights.get(height, 0) + count
+            
+    def report(self, wall):
+        lengths = sorted(self.lengths)
+        print "games:", self.games, "finished:", self.finished
+        print "moves: %i, mean %.1f, median %i, max %i per game"%(self.moves,
+                    float(self.moves) / self.games, lengths[len(lengths)//2], 
+                    lengths[-1])
+        print "moves per second: %.0f per process, %.0f overall"%(
+                    self.moves / self.seconds, self.moves / wall)
+        stacks = sum(self.heights.values())
+        print "final stacks by height:"
+        for height in sorted(self.heights):
+            count = self.heights[height]
+            print "  %3i: %8i  %5.1f%%"%(height, count, 100.0 * count / stacks)
+    
+def run(games, num_players, policies, output, processes=None, seed=0, 
+        max_moves=10000):
+    tasks = [ (seed + i, num_players, policies, max_moves) 
+                for i in range(games) ]
+    totals = Totals()
+    pool = multiprocessing.Pool(processes)
+    started = time.time()
+    try:
+        for result in pool.imap_unordered(play_task, tasks, chunksize=8):
+            output.write(json.dumps(result) + "\n")
+            totals.add(result)
+    finally:
+        pool.close()
+        pool.join()
+    totals.report(time.time() - started)
+    return totals
+    
+    
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("--games", type="int", default=100)
+    parser.add_option("--players", type="int", default=4)
+    parser.add_option("--policy", action="append", dest="policies")
+    parser.add_option("--processes", type="int", default=None)
+    parser.add_option("--seed", type="int", default=0)
+    parser.add_option("--max-moves", type="int", default=10000)
+    parser.add_option("--output", default="simulation.jsonl")
+    options, args = parser.parse_args()
+    
+    output = open(options.output, "w")
+    try:
+        run(options.games, options.players, options.policies or ["random"],
+            output, options.processes, options.seed, options.max_moves)
+    finally:
+        output.close()
@@ -0,0 +1,236 @@
+"""
+Binary snapshots of a whole game.
+
+encode(game) packs a model.Game into a string and decode(data) builds an
+equivalent game from it. All numbers are big endian:
+
+    header      magic, version, game status, board side, seq, winner and
+                how many players, pieces and stacks follow
+    name        the game name
+    players     status, piece on hand, whether it is still in the game, 
+                name and code of every player
+    pieces      owner (index into players) and size of every piece, by id
+    stacks      x, y and height of every stack, then the piece ids of all 
+                the stacks from the bottom up, sorted by position so equal
+                games give equal snapshots
+
+Counts, piece ids and player indexes are 32 bit, positions 16 bit and
+strings have a 16 bit length in front. NONE stands for no piece or winner.
+
+Run this module for encode and decode timings and payload sizes next to
+the maps Perspective Broker sends today.
+"""
+import struct, sys
+from operator import itemgetter
+from array import array
+import model
+
+MAGIC = "CTGS"
+VERSION = 2
+NONE = 0xffffffff
+
+HEADER = struct.Struct("!4sBBHIIIII")
+PLAYER = struct.Struct("!BIB")
+LENGTH = struct.Struct("!H")
+
+class SnapshotError(ValueError): pass
+
+def pack_string(value):
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return LENGTH.pack(len(value)) + value
+    
+def unpack_string(data, offset):
+    length, = unpack_from(LENGTH, data, offset)
+    offset += LENGTH.size
+    return data[offset:offset+length], offset+length
+    
+def pack_array(typecode, values):
+    values = array(typecode, values)
+    if sys.byteorder == "little":
+        values.byteswap()
+    return values.tostring()
+    
+def unpack_array(typecode, data, offset, count):
+    values = array(typecode)
+    end = offset + count*values.itemsize
+    if end > len(data):
+        raise SnapshotError("Truncated snapshot")
+    values.fromstring(data[offset:end])
+    if sys.byteorder == "little":
+        values.byteswap()
+    return values, end
+    
+def unpack_from(format, data, offset):
+    if offset + format.size > len(data):
+        raise SnapshotError("Truncated snapshot")
+    return format.unpack_from(data, offset)
+    
+def encode(game):
+    board = game.board
+    if board is not None:
+        players, pieces, stacks = board.players, board.piece_map, list(board)
+        stacks.sort(key=itemgetter(0))
+        side = board.side
+    else:
+        players, pieces, stacks, side = game.players, [], [], 0
+    index = dict( (p, i) for i, p in enumerate(players) )
+    playing = set(game.players)
+    
+    parts = [ HEADER.pack(MAGIC, VERSION, game.status, side, game.seq, 
+                        index.get(game.winner, NONE),
+                        len(players), len(pieces), len(stacks)),
+              pack_string(game.name) ]
+    for p in players:
+        on_hand = NONE
+        if p.on_hand is not None:
+            on_hand = p.on_hand.id
+        parts.append( PLAYER.pack(p.status, on_hand, p in playing) )
+        parts.append( pack_string(p.name) )
+        parts.append( pack_string(p.code or "") )
+        
+    parts.append( pack_array("I", [ index[p.player] for p in pieces ]) )
+    parts.append( pack_array("B", [ p.size for p in pieces ]) )
+    
+    positions = []
+    heights = []
+    ids = []
+    for where, stack in stacks:
+        positions.extend(where)
+        heights.append(len(stack))
+        ids.extend( p.id for p in stack )
+    parts.append( pack_array("h", positions) )
+    parts.append( pack_array("I", heights) )
+    parts.append( pack_array("I", ids) )
+    return "".join(parts)
+    
+def decode(data, server=None):
+    """ a new model.Game, it is not added to the server's games """
+    if data[:len(MAGIC)] != MAGIC:
+        raise SnapshotError("Not a game snapshot")
+    (magic, version, status, side, seq, winner, 
+        num_players, num_pieces, num_stacks) = unpack_from(HEADER, data, 0)
+    if version != VERSION:
+        raise SnapshotError("Unknown snapshot version %i"%version)
+    name, offset = unpack_string(data, HEADER.size)
+    
+    if server is None:
+        server = model.Server()
+    game = model.Game(name, server)
+    game.status = status
+    game.seq = seq
+    
+    players = []
+    hands = []
+    for i in range(num_players):
+        status, on_hand, playing = unpack_from(PLAYER, data, offset)
+        name, offset = unpack_string(data, offset + PLAYER.size)
+        code, offset = unpack_string(data, offset)
+        player = model.Player(name, game)
+        player.status = status
+        player.code = code or None
+        players.append(player)
+        hands.append(on_hand)
+        if playing:
+            game.players.append(player)
+    if winner != NONE:
+        game.winner = players[winner]
+            
+    owners, offset = unpack_array("I", data, offset, num_pieces)
+    sizes, offset = unpack_array("B", data, offset, num_pieces)
+    positions, offset = unpack_array("h", data, offset, num_stacks*2)
+    heights, offset = unpack_array("I", data, offset, num_stacks)
+    ids, offset = unpack_array("I", data, offset, sum(heights))
+    
+    if side:
+        pieces = [ (players[owner], size) for owner, size in zip(owners, sizes) ]
+        stacks = []
+        start = 0
+        for i, height in enumerate(heights):
+            where = positions[2*i], positions[2*i+1]
+            stacks.append( (where, ids[start:start+height]) )
+            start += height
+        game.board = server.board_factory(players, (side, pieces, stacks))
+        
+        for player, on_hand in zip(players, hands):
+            if on_hand != NONE:
+                player.on_hand = game.board.piece_map[on_hand]
+    return game
+    
+    
+### BENCHMARK ###
+
+def bench(player_counts=(2, 4, 8, 16), repeat=200):
+    import timeit
+    from twisted.spread import banana, jelly
+    
+    print "%8s %10s %10s %12s %12s"%("players", "snapshot", "pb maps",
+                                      "encode us", "decode us")
+    for num_players in player_counts:
+        game = model.play_randomly(model.game_for(num_players), 10*num_players)
+        data = encode(game)
+        maps = (game.get_piece_map(), game.get_board_map())
+        pb_size = len(banana.encode(jelly.jelly(maps)))
+        
+        encoding = timeit.timeit(lambda: encode(game), number=repeat)
+        decoding = timeit.timeit(lambda: decode(data), number=repeat)
+        print "%8i %10i %10i %12.1f %12.1f"%(num_players, len(data), pb_size,
+                        encoding*1e6/repeat, decoding*1e6/repeat)
+    
+if __name__ == "__main__":
+    bench()
+    
+    
+### TESTS ###
+
+import unittest
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.verbose = model.VERBOSE
+        model.VERBOSE = False
+        
+    def tearDown(self):
+        model.VERBOSE = self.verbose
+        
+    def same(self, game, copied):
+        self.assertEqual(copied.name, game.name)
+        self.assertEqual(copied.status, game.status)
+        self.assertEqual(copied.seq, game.seq)
+        self.assertEqual([ (p.name, p.status, p.code) for p in copied.players ],
+                         [ (p.name, p.status, p.code) for p in game.players ])
+        if game.board is not None:
+            self.assertEqual(copied.get_board_map(), game.get_board_map())
+            self.assertEqual(copied.get_piece_map(), game.get_piece_map())
+            self.assertEqual(copied.board.side, game.board.side)
+            self.assertEqual(sorted(copied.board.empty), sorted(game.board.empty))
+        hands = lambda g: [ p.on_hand and p.on_hand.id for p in g.players ]
+        self.assertEqual(hands(copied), hands(game))
+        
+    def testroundtrip(self):
+        game = model.play_randomly(model.game_for(3), 40)
+        data = encode(game)
+        copied = decode(data)
+        self.same(game, copied)
+        self.assertEqual(encode(copied), data)
+        
+    def testbig(self):
+        game = model.game_for(4370)
+        piece = game.board.piece_map[0xffff]
+        where = [ w for w, s in game.get_board_map().items() if s == [piece.id] ]
+        piece.player.pick(where[0])
+        data = encode(game)
+        copied = decode(data)
+        self.same(game, copied)
+        self.assertEqual(encode(copied), data)
+        
+    def testwaiting(self):
+        game = model.Server().create_game("waiting")
+        game.join("p1")
+        self.same(game, decode(encode(game)))
+        
+    def testbroken(self):
+        data = encode(model.game_for(2))
+        self.assertRaises(SnapshotError, decode, "nope")
+        self.assertRaises(SnapshotError, decode, data[:-3])
+        self.assertRaises(SnapshotError, decode, data[:4] + "\xff" + data[5:])
@@ -0,0 +1,363 @@
+"""
+A lighter transport than Perspective Broker.
+
+Messages are JSON documents with a 32 bit length in front, and either side
+can call the other:
+
+    ["c", id, handle, method, args]     calls remote_<method> on an object
+    ["a", id, result]                   its answer
+    ["e", id, message]                  or the error it raised
+    ["f", handle]                       the caller is done with an object
+
+Handle 0 is the server's root, a server.NetworkServer, so the lobby and the
+moves work as they do over PB. Referenceables in arguments and results go
+across as {"r": handle} and come out on the other side as a Handle with a
+callRemote() of its own, which is how set_board, watch and subscribe reach
+back to the client. An object stays exported, and alive, until the other
+side calls release() on its Handle or the connection is lost, so clients
+that go through many games should release the ones they are done with;
+the root is never released. Tuples go as {"t": [...]}, dicts as {"d": [[key,
+value], ...]} and strings that are not ASCII as {"b": base64}.
+
+    python server.py --wire-port 9092
+    python wire.py          # PB against this on localhost
+"""
+import json, base64, time
+from twisted.spread import pb
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.internet import protocol, defer, reactor
+import server
+
+MAX_LENGTH = 16 * 1024 * 1024
+
+class WireError(Exception): pass
+
+class Handle:
+    """ an object on the other side """
+    def __init__(self, protocol, number):
+        self.protocol = protocol
+        self.number = number
+
+    def callRemote(self, method, *args):
+        return self.protocol.call(self.number, method, args)
+
+    def release(self):
+        """ tells the other side this object is not needed any more """
+        self.protocol.release(self.number)
+
+    def notifyOnDisconnect(self, callback):
+        self.protocol.on_lost.append(lambda: callback(self))
+
+    def __eq__(self, other):
+        return isinstance(other, Handle) and \
+                (self.protocol, self.number) == (other.protocol, other.number)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.protocol), self.number))
+
+class WireProtocol(Int32StringReceiver):
+    MAX_LENGTH = MAX_LENGTH
+
+    def __init__(self, root=None):
+        self.local = {}
+        self.numbers = {}
+        self.waiting = {}
+        self.next_call = 1
+        self.next_handle = 0
+        self.on_lost = []
+        if root is not None:
+            self.export(root)
+
+    def export(self, obj):
+        if not id(obj) in self.numbers:
+            number = self.next_handle
+            self.next_handle += 1
+            self.local[number] = obj
+            self.numbers[id(obj)] = number
+        return self.numbers[id(obj)]
+
+    def forget(self, number):
+        """ stops exporting an object, the root stays """
+        if number and number in self.local:
+            del self.numbers[id(self.local.pop(number))]
+
+    def encode(self, value):
+        if isinstance(value, pb.Referenceable):
+            return {"r": self.export(value)}
+        if isinstance(value, list):
+            return [ self.encode(v) for v in value ]
+        if isinstance(value, tuple):
+            return {"t": [ self.encode(v) for v in value ]}
+        if isinstance(value, dict):
+            return {"d": [ [self.encode(k), self.encode(v)]
+                            for k, v in value.iteritems() ]}
+        if isinstance(value, str):
+            try:
+                value.decode("ascii")
+            except UnicodeDecodeError:
+                return {"b": base64.b64encode(value)}
+        return value
+
+    def decode(self, value):
+        if isinstance(value, list):
+            return [ self.decode(v) for v in value ]
+        if isinstance(value, dict):
+            if "t" in value:
+                return tuple([ self.decode(v) for v in value["t"] ])
+            if "r" in value:
+                return Handle(self, value["r"])
+            if "d" in value:
+                return dict( (self.decode(k), self.decode(v))
+                                for k, v in value["d"] )
+            if "b" in value:
+                return base64.b64decode(value["b"])
+            raise WireError("Unknown value")
+        if isinstance(value, unicode):
+            try:
+                return value.encode("ascii")
+            except UnicodeEncodeError:
+                return value
+        return value
+
+    def send(self, message):
+        self.sendString(json.dumps(message, separators=(",", ":")))
+
+    def call(self, number, method, args):
+        id = self.next_call
+        self.next_call += 1
+        d = self.waiting[id] = defer.Deferred()
+        self.send(["c", id, number, method, self.encode(list(args))])
+        return d
+
+    def release(self, number):
+        self.send(["f", number])
+
+    def stringReceived(self, data):
+        message = json.loads(data)
+        kind, id = message[:2]
+        if kind == "c":
+            number, method, args = message[2:]
+            d = defer.maybeDeferred(self.dispatch, number, method,
+                                    self.decode(args))
+            d.addCallbacks(self.answer, self.error,
+                           callbackArgs=(id,), errbackArgs=(id,))
+        elif kind == "a":
+            self.waiting.pop(id).callback(self.decode(message[2]))
+        elif kind == "e":
+            self.waiting.pop(id).errback(WireError(message[2]))
+        elif kind == "f":
+            self.forget(id)
+
+    def dispatch(self, number, method, args):
+        if not number in self.local:
+            raise WireError("No such object")
+        handler = getattr(self.local[number], "remote_" + method, None)
+        if handler is None:
+            raise WireError("No such method: remote_%s" % method)
+        return handler(*args)
+
+    def answer(self, result, id):
+        self.send(["a", id, self.encode(result)])
+
+    def error(self, failure, id):
+        self.send(["e", id, failure.getErrorMessage()])
+
+    def connectionLost(self, reason):
+        waiting, self.waiting = self.waiting, {}
+        for d in waiting.values():
+            d.errback(WireError("Connection lost"))
+        for callback in self.on_lost:
+            callback()
+        self.local = {}
+        self.numbers = {}
+
+class WireServerFactory(protocol.ServerFactory):
+    def __init__(self, root):
+        self.root = root
+
+    def buildProtocol(self, addr):
+        return WireProtocol(self.root)
+
+def connect(host, port):
+    """ a Deferred with a Handle on the server's root """
+    d = protocol.ClientCreator(reactor, WireProtocol).connectTCP(host, port)
+    d.addCallback(lambda proto: Handle(proto, 0))
+    return d
+
+### TESTS ###
+
+import unittest
+from twisted.test import iosim
+
+class Echo(pb.Referenceable):
+    def __init__(self):
+        self.got = []
+
+    def remote_echo(self, value):
+        self.got.append(value)
+        return value
+
+    def remote_fail(self):
+        raise server.ServerError("Nope")
+
+    def remote_later(self):
+        return defer.Deferred()
+
+    def remote_child(self):
+        return Echo()
+
+    def remote_back(self, other, value):
+        """ calls other, which lives on the caller's side """
+        return other.callRemote("echo", value)
+
+class TestWire(unittest.TestCase):
+    def setUp(self):
+        self.root = Echo()
+        self.client, self.server, self.pump = iosim.connectedServerAndClient(
+                lambda: WireProtocol(self.root), WireProtocol)
+        self.remote = Handle(self.client, 0)
+
+    def call(self, remote, method, *args):
+        """ the result of a call, or the Failure it ends in """
+        results = []
+        d = remote.callRemote(method, *args)
+        d.addBoth(results.append)
+        self.pump.flush()
+        self.assertEqual(len(results), 1)
+        return results[0]
+
+    def testvalues(self):
+        board = {(0, 1): [3, 4], (2, 3): []}
+        for value in [board, u"\xf1and\xfa", "\xff\x00bytes", "ascii",
+                      (1, (2, "x")), [None, True, 1.5, {}], {"t": 1, "r": 2}]:
+            self.assertEqual(self.call(self.remote, "echo", value), value)
+        self.assertEqual(self.root.got[0], board)
+        self.assertEqual(type(self.root.got[-1].keys()[0]), str)
+
+    def testhandles(self):
+        child = self.call(self.remote, "child")
+        self.assertTrue(isinstance(child, Handle))
+        self.assertEqual(self.call(child, "echo", 1), 1)
+        self.assertEqual(self.call(self.remote, "child"), 
+                         Handle(self.client, 2))
+
+        mine = Echo()
+        self.assertEqual(self.call(self.remote, "back", mine, (1, 2)), (1, 2))
+        self.assertEqual(mine.got, [(1, 2)])
+        self.assertEqual(len(self.client.local), 1)
+
+        child.release()
+        self.pump.flush()
+        self.assertFalse(child.number in self.server.local)
+        self.assertEqual(len(self.server.numbers), len(self.server.local))
+        Handle(self.client, 0).release()
+        self.pump.flush()
+        self.assertTrue(self.server.local[0] is self.root)
+
+    def testerrors(self):
+        for method, message in [("fail", "Nope"),
+                                ("missing", "No such method: remote_missing")]:
+            failure = self.call(self.remote, method)
+            failure.trap(WireError)
+            self.assertEqual(failure.getErrorMessage(), message)
+        failure = self.call(Handle(self.client, 7), "echo", 1)
+        self.assertEqual(failure.getErrorMessage(), "No such object")
+
+    def testlost(self):
+        results = []
+        self.remote.callRemote("later").addErrback(results.append)
+        lost = []
+        self.remote.notifyOnDisconnect(lost.append)
+        self.pump.flush()
+        self.client.transport.loseConnection()
+        self.pump.flush()
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0].getErrorMessage(), "Connection lost")
+        self.assertEqual(lost, [self.remote])
+        self.assertEqual(self.client.waiting, {})
+
+class TestMoves(unittest.TestCase):
+    """ positions sent as plain JSON lists """
+    def setUp(self):
+        import model
+        self.verbose = model.VERBOSE
+        model.VERBOSE = False
+        self.root = server.NetworkServer()
+        self.client, self.server, self.pump = iosim.connectedServerAndClient(
+                lambda: WireProtocol(self.root), WireProtocol)
+
+    def tearDown(self):
+        import model
+        model.VERBOSE = self.verbose
+
+    def testpick(self):
+        game = self.root.server.create_game("plain")
+        one, two = game.join("one"), game.join("two")
+        one.set_ready()
+        two.set_ready()
+        number = self.server.export(server.NetworkPlayer(one))
+        where = [ w for w, s in game.board if len(s) == 1 and 
+                    s[0].player is one ][0]
+        results = []
+        self.client.call(number, "pick", [list(where)]).addBoth(results.append)
+        self.pump.flush()
+        self.assertEqual(results, [game.seq])
+        self.assertFalse(where in game.get_board_map())
+        self.assertTrue(one.on_hand is not None)
+
+### BENCHMARK ###
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+@defer.inlineCallbacks
+def measure(root, calls, burst):
+    """ round trips one at a time, then burst calls at once """
+    game = yield root.callRemote("create_game", "bench")
+    player = yield game.callRemote("join", "bench")
+    latencies = []
+    for i in range(calls):
+        started = time.time()
+        yield game.callRemote("player_status")
+        latencies.append(time.time() - started)
+    started = time.time()
+    yield defer.gatherResults([ game.callRemote("player_status")
+                                    for i in range(burst) ])
+    rate = burst / (time.time() - started)
+    yield player.callRemote("leave")
+    defer.returnValue( (latencies, rate) )
+
+@defer.inlineCallbacks
+def bench(calls=2000, burst=5000):
+    import model
+    model.VERBOSE = False
+    root = server.NetworkServer()
+    pb_port = reactor.listenTCP(0, pb.PBServerFactory(root),
+                                interface="127.0.0.1")
+    wire_port = reactor.listenTCP(0, WireServerFactory(root),
+                                  interface="127.0.0.1")
+    try:
+        factory = pb.PBClientFactory()
+        reactor.connectTCP("127.0.0.1", pb_port.getHost().port, factory)
+        roots = [ ("pb", (yield factory.getRootObject())),
+                  ("wire", (yield connect("127.0.0.1",
+                                          wire_port.getHost().port))) ]
+        print "transport   p50 ms   p99 ms   calls/s one by one   calls/s in bursts"
+        for name, remote in roots:
+            latencies, rate = yield measure(remote, calls, burst)
+            print "%-9s %8.3f %8.3f %20.0f %19.0f" % (name,
+                    percentile(latencies, 0.5) * 1000,
+                    percentile(latencies, 0.99) * 1000,
+                    len(latencies) / sum(latencies), rate)
+    except Exception:
+        import traceback
+        traceback.print_exc()
+    reactor.stop()
+
+if __name__ == "__main__":
+    reactor.callWhenRunning(bench)
+    reactor.run()